@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Time to the first result versus steady state throughput of the default
+O3 compilation and of the tiered mode.
+
+    $ python benchmarks/tiered.py
+"""
+import time
+
+import numpy as np
+
+import fastpy.fastpy as fastpy
+from fastpy import fast
+
+def kernel(a, n):
+    acc = 0
+    for i in range(n):
+        acc += a[i] * a[i]
+    return acc
+
+def measure(decorated, a, calls):
+    start = time.time()
+    decorated(a, a.shape[0])
+    first = time.time() - start
+
+    # Get past the quick tier and wait for the O3 recompilation.
+    for _ in range(fastpy.hot_threshold):
+        decorated(a, a.shape[0])
+    fastpy.background_executor().submit(lambda: None).result()
+
+    start = time.time()
+    for _ in range(calls):
+        decorated(a, a.shape[0])
+    steady = (time.time() - start) / calls
+    return first, steady
+
+if __name__ == '__main__':
+    a = np.random.rand(100000)
+    calls = 100
+    for tiered in [False, True]:
+        first, steady = measure(fast(kernel, tiered=tiered), a, calls)
+        print('tiered=%-5s first call %8.2f ms, steady state %8.3f ms/call' %
+              (tiered, first * 1e3, steady * 1e3))
@@ -4,4 +4,4 @@ __author__ = 'Ignacio Tartavull'
 __email__ = 'tartavull@gmail.com'
 __version__ = '0.1.1'
 
-from fastpy import fast
\ No newline at end of file
+from fastpy import fast, pipeline, jitclass, warmup, record
\ No newline at end of file
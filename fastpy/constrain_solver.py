@@ -1,5 +1,7 @@
 from collections import deque
-from type_system import TApp, TCon, TFun, TVar, ftv
+from type_system import TApp, TCon, TFun, TVar, TTuple, TRecord, TField, TElement, ftv, is_array, promote
+from type_system import is_object, TArithmetic, boolean, int64
+from type_inference import InferError
 
 class ConstrainSolver(object):
     """
@@ -28,14 +30,22 @@ class ConstrainSolver(object):
     def empty(self):
         return {}
     def apply(self, s, t):
-        if isinstance(t, TCon):
+        if isinstance(t, (TCon, TRecord)):
             return t
+        elif isinstance(t, TField):
+            return TField(self.apply(s, t.record), t.name)
+        elif isinstance(t, TElement):
+            return TElement(self.apply(s, t.type))
+        elif isinstance(t, TArithmetic):
+            return TArithmetic(self.apply(s, t.type))
         elif isinstance(t, TApp):
             return TApp(self.apply(s, t.a), self.apply(s, t.b))
         elif isinstance(t, TFun):
             argtys = [self.apply(s, a) for a in t.argtys]
             retty = self.apply(s, t.retty)
             return TFun(argtys, retty)
+        elif isinstance(t, TTuple):
+            return TTuple([self.apply(s, a) for a in t.types])
         elif isinstance(t, TVar):
             return s.get(t.s, t)
     def applyList(self, s, xs):
@@ -48,12 +58,18 @@ class ConstrainSolver(object):
             return self.compose(s2, s1)
         elif isinstance(x, TCon) and isinstance(y, TCon) and (x == y):
             return self.empty()
+        elif isinstance(x, TRecord) and isinstance(y, TRecord) and (x == y):
+            return self.empty()
         elif isinstance(x, TFun) and isinstance(y, TFun):
             if len(x.argtys) != len(y.argtys):
                 return Exception("Wrong number of arguments")
             s1 = self.solve(zip(x.argtys, y.argtys))
             s2 = self.unify(self.apply(s1, x.retty), self.apply(s1, y.retty))
             return self.compose(s2, s1)
+        elif isinstance(x, TTuple) and isinstance(y, TTuple):
+            if len(x.types) != len(y.types):
+                raise InferError(x, y)
+            return self.solve(zip(x.types, y.types))
         elif isinstance(x, TVar):
             return self.bind(x.s, y)
         elif isinstance(y, TVar):
@@ -87,4 +103,59 @@ class ConstrainSolver(object):
     
     def compose(self, s1, s2):
         s3 = dict((t, self.apply(s1, u)) for t, u in s2.items())
-        return self.union(s1, s3)
\ No newline at end of file
+        return self.union(s1, s3)
+
+    def promote(self, s, promotions):
+        """
+        Solve the promotion constraints (ty, tv) generated by TypeInfer, 
+        meaning ty has to be promoted to tv.
+
+        This can only be done once the arguments types are known. 
+        Every type variable starts at the bottom of the lattice and 
+        is widened to the promotion of its lower bounds until a 
+        fixed point is reached.
+
+        Args:
+            s (dict): Substitution with the argument types applied
+            promotions (list): (ty, tv) pairs
+
+        Returns:
+            dict: The substitution extended with the promoted types
+        """
+        bounds = self.empty()
+        changed = True
+        while changed:
+            changed = False
+            for (ty, tv) in promotions:
+                ty = self.apply(bounds, self.apply(s, ty))
+                if ftv(ty):
+                    continue
+                if isinstance(ty, TField):
+                    # The record is known now, take the type of the field.
+                    record = ty.record.b if is_object(ty.record) else ty.record
+                    if not isinstance(record, TRecord) or record.field(ty.name) is None:
+                        raise InferError(ty, ty.record)
+                    ty = record.field(ty.name)
+                elif isinstance(ty, TElement):
+                    ty = ty.type.b if is_array(ty.type) else ty.type
+                elif isinstance(ty, TArithmetic):
+                    ty = int64 if ty.type == boolean else ty.type
+                target = self.apply(s, tv)
+                if not isinstance(target, TVar):
+                    target = self.apply(bounds, target)
+                if isinstance(target, TVar):
+                    bound = bounds.get(target.s, ty)
+                    joined = promote(bound, ty)
+                    if joined is None:
+                        raise InferError(ty, bound)
+                    if bounds.get(target.s) != joined:
+                        bounds[target.s] = joined
+                        changed = True
+                elif is_array(target) or is_array(ty):
+                    unifier = self.unify(target, ty)
+                    if unifier:
+                        s = self.compose(unifier, s)
+                        changed = True
+                elif promote(target, ty) != target:
+                    raise InferError(ty, target)
+        return self.compose(bounds, s)
\ No newline at end of file
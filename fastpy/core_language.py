@@ -1,154 +1,254 @@
+"""
+Core language the Python AST is translated to.
+
+Nodes are immutable: their fields are slots set by the constructor, lists
+become tuples, and they compare and hash by structure, with the hash
+computed once. Types aren't stored on the nodes, type inference returns
+them in a side table indexed by node, so a tree can be shared by all the
+specializations and threads, and used as a key of a compile cache. Equal
+nodes of a function have the same type, a variable has a single type in
+the whole function.
+"""
 import ast
+from collections import deque
 
-class Var(ast.AST):
+class Node(object):
+    """Base of the core language nodes.
+
+    Attributes:
+        _hash (int): Structural hash of the node
+    """
+    __slots__ = ["_hash"]
+    _fields = []
+
+    def __init__(self, *values):
+        if len(values) != len(self._fields):
+            raise TypeError("%s takes %d fields, %d given"
+                            % (type(self).__name__, len(self._fields), len(values)))
+        for (name, value) in zip(self._fields, values):
+            object.__setattr__(self, name, tuple(value) if isinstance(value, list) else value)
+        object.__setattr__(self, "_hash", hash((type(self).__name__,) + structure(self)))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("%s nodes are immutable" % type(self).__name__)
+
+    def __eq__(self, other):
+        return self is other or (type(self) is type(other) and self._hash == other._hash
+                                 and structure(self) == structure(other))
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return self._hash
+
+    def __repr__(self):
+        return "%s(%s)" % (type(self).__name__, ", ".join(map(repr, values_of(self))))
+
+def values_of(node):
+    return tuple(getattr(node, name) for name in node._fields)
+
+def structure(node):
+    """Values of the fields as compared and hashed. Floats are compared by
+    their type and repr, 0.0 and -0.0 are different literals and NaN is
+    equal to itself."""
+    return tuple((type(value), repr(value)) if isinstance(value, float) else value
+                 for value in values_of(node))
+
+def iter_fields(node):
+    """Yields the (name, value) of the fields of a node, like ast.iter_fields."""
+    for name in node._fields:
+        yield name, getattr(node, name)
+
+def iter_child_nodes(node):
+    """Yields the direct children of a node, like ast.iter_child_nodes."""
+    for (_, value) in iter_fields(node):
+        if isinstance(value, Node):
+            yield value
+        elif isinstance(value, tuple):
+            for item in value:
+                if isinstance(item, Node):
+                    yield item
+
+def walk(node):
+    """Yields a node and all its descendants, like ast.walk."""
+    todo = deque([node])
+    while todo:
+        node = todo.popleft()
+        todo.extend(iter_child_nodes(node))
+        yield node
+
+class Var(Node):
     """Variable
-    
+
     Attributes:
         id (TYPE): Description
-        type (TYPE): Description
     """
-    _fields = ["id", "type"]
+    __slots__ = _fields = ["id"]
 
-    def __init__(self, id, type=None):
-        self.id = id
-        self.type = type
-
-class Assign(ast.AST):
+class Assign(Node):
     """Assignment
-    
+
     Attributes:
         ref (TYPE): Description
-        type (TYPE): Description
         val (TYPE): Description
     """
-    _fields = ["ref", "val", "type"]
+    __slots__ = _fields = ["ref", "val"]
 
-    def __init__(self, ref, val, type=None):
-        self.ref = ref
-        self.val = val
-        self.type = type
-
-class Return(ast.AST):
+class Return(Node):
     """Return
-    
+
     Attributes:
         val (TYPE): Description
     """
-    _fields = ["val"]
+    __slots__ = _fields = ["val"]
 
-    def __init__(self, val):
-        self.val = val
-
-class Loop(ast.AST):
+class Loop(Node):
     """Loop Construct
-    
+
     Attributes:
         begin (TYPE): Description
         body (TYPE): Description
         end (TYPE): Description
         var (TYPE): Description
     """
-    _fields = ["var", "begin", "end", "body"]
+    __slots__ = _fields = ["var", "begin", "end", "body"]
 
-    def __init__(self, var, begin, end, body):
-        self.var = var
-        self.begin = begin
-        self.end = end
-        self.body = body
-
-class App(ast.AST):
+class App(Node):
     """Variadic Application
-    
+
     Attributes:
         args (TYPE): Description
         fn (TYPE): Description
     """
-    _fields = ["fn", "args"]
+    __slots__ = _fields = ["fn", "args"]
 
-    def __init__(self, fn, args):
-        self.fn = fn
-        self.args = args
-
-class Fun(ast.AST):
+class Fun(Node):
     """Variadic Function
-    
+
     Attributes:
         args (TYPE): Description
         body (TYPE): Description
         fname (TYPE): Description
     """
-    _fields = ["fname", "args", "body"]
+    __slots__ = _fields = ["fname", "args", "body"]
 
-    def __init__(self, fname, args, body):
-        self.fname = fname
-        self.args = args
-        self.body = body
-
-class LitInt(ast.AST):
+class LitInt(Node):
     """Integer
-    
+
     Attributes:
         n (TYPE): Description
-        type (TYPE): Description
     """
-    _fields = ["n"]
+    __slots__ = _fields = ["n"]
 
-    def __init__(self, n, type=None):
-        self.n = n
-        self.type = type
-
-class LitFloat(ast.AST):
+class LitFloat(Node):
     """Float
-    
+
     Attributes:
         n (TYPE): Description
-        type (TYPE): Description
     """
-    _fields = ["n"]
+    __slots__ = _fields = ["n"]
 
-    def __init__(self, n, type=None):
-        self.n = n
-        self.type = None
-
-class LitBool(ast.AST):
+class LitBool(Node):
     """Boolean
-    
+
     Attributes:
         n (TYPE): Description
     """
-    _fields = ["n"]
-
-    def __init__(self, n):
-        self.n = n
+    __slots__ = _fields = ["n"]
 
 primops = {ast.Add: "add#", ast.Mult: "mult#"}
-class Prim(ast.AST):
+class Prim(Node):
     """Primitive Operation
-    
+
     Attributes:
         args (TYPE): Description
         fn (TYPE): Description
     """
-    _fields = ["fn", "args"]
+    __slots__ = _fields = ["fn", "args"]
 
-    def __init__(self, fn, args):
-        self.fn = fn
-        self.args = args
-
-class Index(ast.AST):
+class Index(Node):
     """Array indexing
-    
+
     Attributes:
         ix (TYPE): Description
         val (TYPE): Description
     """
-    _fields = ["val", "ix"]
+    __slots__ = _fields = ["val", "ix"]
 
-    def __init__(self, val, ix):
-        self.val = val
-        self.ix = ix
-
-class Noop(ast.AST):
+class Noop(Node):
     """No operation
     """
-    _fields = []
+    __slots__ = _fields = []
+
+class SetIndex(Node):
+    """Array element assignment
+
+    Attributes:
+        expr (TYPE): Description
+        ix (TYPE): Description
+        val (TYPE): Description
+    """
+    __slots__ = _fields = ["val", "ix", "expr"]
+
+class Broadcast(Node):
+    """Element of an array in a whole array expression, scalars are
+    broadcast to every element
+
+    Attributes:
+        ix (TYPE): Description
+        val (TYPE): Array or scalar
+    """
+    __slots__ = _fields = ["val", "ix"]
+
+class Reduce(Node):
+    """Reduction of a whole array expression
+
+    Attributes:
+        elt (TYPE): Element ix of the expression
+        fn (TYPE): One of add#, mean#, min#, max#, argmin# or argmax#
+        ix (TYPE): Index variable
+        size (TYPE): Number of elements
+    """
+    __slots__ = _fields = ["fn", "elt", "ix", "size"]
+
+class Field(Node):
+    """Field of a record
+
+    Attributes:
+        name (TYPE): Description
+        val (TYPE): Description
+    """
+    __slots__ = _fields = ["val", "name"]
+
+class SetField(Node):
+    """Field assignment of a record stored in an array
+
+    Attributes:
+        expr (TYPE): Description
+        name (TYPE): Description
+        val (TYPE): Index of the record
+    """
+    __slots__ = _fields = ["val", "name", "expr"]
+
+class Alloc(Node):
+    """Array allocation
+
+    Attributes:
+        elt (TYPE): Element type, None to take the one of like
+        like (TYPE): Array whose shape is copied
+        shape (TYPE): Size of every dimension
+        zero (TYPE): Whether the array is filled with zeros
+    """
+    __slots__ = _fields = ["shape", "like", "elt", "zero"]
+
+    def __init__(self, shape, like=None, elt=None, zero=False):
+        Node.__init__(self, shape, like, elt, zero)
+
+class Tuple(Node):
+    """Tuple
+
+    Attributes:
+        elts (TYPE): Description
+    """
+    __slots__ = _fields = ["elts"]
@@ -1,10 +1,25 @@
 import ast
 import types
+from itertools import count
 from textwrap import dedent
 import inspect
 
-from core_language import Var, Prim, Return, Fun, primops, LitBool, LitFloat, LitInt, Assign, Loop
-from type_system import int32, int64
+from core_language import Var, Prim, Return, Fun, primops, LitBool, LitFloat, LitInt, Assign, Loop, Index, App, Noop
+from core_language import SetIndex, Alloc, Tuple, Field, SetField, Broadcast, Reduce, walk
+from type_system import double64, dtype_names
+
+# NumPy functions which allocate a new array.
+allocators = {"empty", "zeros", "empty_like", "zeros_like"}
+
+# Reductions, available as NumPy functions and array methods.
+reductions = {"sum": "add#", "mean": "mean#", "min": "min#", "max": "max#",
+              "amin": "min#", "amax": "max#", "argmin": "argmin#", "argmax": "argmax#"}
+builtin_reductions = {"sum", "min", "max"}
+
+def operands(elt):
+    """Variables of the element of a whole array expression, whose sizes
+    are checked against each other."""
+    return [n.val for n in walk(elt) if isinstance(n, Broadcast) and isinstance(n.val, Var)]
 
 class CoreTranslator(ast.NodeVisitor):
     """
@@ -56,10 +71,13 @@ class CoreTranslator(ast.NodeVisitor):
       'fname': "'add'"})
 
     The type is going to be infered later on.
+
+    Whole array expressions, like c[:] = a * b + d or (a * b).sum(), are
+    fused into a single loop over the elements, without temporaries.
     """
 
     def __init__(self):
-        pass
+        self.temps = count()
 
     def translate(self, source):
         if isinstance(source, types.ModuleType):
@@ -94,11 +112,101 @@ class CoreTranslator(ast.NodeVisitor):
         return LitBool(node.n)
 
     def visit_Call(self, node):
+        func = node.func
+        if (isinstance(func, ast.Attribute) and isinstance(func.value, ast.Name)
+                and func.value.id in {"np", "numpy"}):
+            if func.attr in allocators:
+                return self.visit_Alloc(node)
+            elif func.attr == "dot" and len(node.args) == 2:
+                # Only for 1D arrays.
+                return self.reduction("add#", ast.BinOp(node.args[0], ast.Mult(), node.args[1]))
+            elif func.attr in reductions and len(node.args) == 1:
+                return self.reduction(reductions[func.attr], node.args[0])
+        elif isinstance(func, ast.Attribute) and func.attr in reductions and not node.args:
+            return self.reduction(reductions[func.attr], func.value)
+        elif isinstance(func, ast.Name) and func.id in builtin_reductions:
+            if len(node.args) == 1:
+                return self.reduction(reductions[func.id], node.args[0])
+            elif func.id in {"min", "max"}:
+                fn = reductions[func.id]
+                return reduce(lambda a, b: Prim(fn, [a, b]), map(self.visit, node.args))
         name = self.visit(node.func)
         args = map(self.visit, node.args)
         keywords = map(self.visit, node.keywords)
         return App(name, args)
 
+    def visit_Alloc(self, node):
+        fname = node.func.attr
+        args = list(node.args)
+        kwargs = dict((kw.arg, kw.value) for kw in node.keywords)
+        if len(args) > 1:
+            kwargs["dtype"] = args[1]
+        elt = self.dtype(kwargs["dtype"]) if "dtype" in kwargs else None
+        zero = fname.startswith("zeros")
+
+        if fname.endswith("_like"):
+            return Alloc(None, like=self.visit(args[0]), elt=elt, zero=zero)
+        if isinstance(args[0], ast.Tuple):
+            shape = map(self.visit, args[0].elts)
+        else:
+            shape = [self.visit(args[0])]
+        return Alloc(shape, elt=elt or double64, zero=zero)
+
+    def dtype(self, node):
+        """Resolves the dtype argument of an allocation, which can be given
+        as np.float32, 'float32' or a builtin like float.
+        """
+        if isinstance(node, ast.Attribute):
+            name = node.attr
+        elif isinstance(node, ast.Name):
+            name = node.id
+        elif isinstance(node, ast.Str):
+            name = node.s
+        else:
+            raise NotImplementedError
+        if name not in dtype_names:
+            raise Exception("dtype not supported: %s" % name)
+        return dtype_names[name]
+
+    def temp(self, prefix):
+        # Not a valid Python identifier, so it can't clash with the user's names.
+        return "%s.%d" % (prefix, next(self.temps))
+
+    def elementwise(self, node, ix):
+        """Element ix of a whole array expression."""
+        if self.whole(node):
+            return self.elementwise(node.value, ix)
+        if isinstance(node, ast.BinOp):
+            opname = primops[node.op.__class__]
+            return Prim(opname, [self.elementwise(node.left, ix),
+                                 self.elementwise(node.right, ix)])
+        return Broadcast(self.visit(node), ix)
+
+    def fused_store(self, target, node):
+        """
+        c[:] = expr as a loop over the elements of c, the operands 
+        must have the same number of elements, which is checked at runtime.
+        """
+        ix = Var(self.temp("i"))
+        elt = self.elementwise(node, ix)
+        body = [SetIndex(self.visit(target), ix, elt)]
+        size = Prim("size#", [self.visit(target)] + operands(elt))
+        return Loop(ix, LitInt(0), size, body)
+
+    def reduction(self, fn, node):
+        """Reduction of a whole array expression over the elements of its
+        first array operand, the others must have as many elements, like
+        both arrays of np.dot."""
+        ix = Var(self.temp("i"))
+        elt = self.elementwise(node, ix)
+        return Reduce(fn, elt, ix, Prim("size#", operands(elt)))
+
+    def whole(self, node):
+        """Matches a[:]"""
+        return (isinstance(node, ast.Subscript) and isinstance(node.slice, ast.Slice)
+                and node.slice.lower is None and node.slice.upper is None
+                and node.slice.step is None)
+
     def visit_BinOp(self, node):
         op_str = node.op.__class__
         a = self.visit(node.left)
@@ -106,17 +214,41 @@ class CoreTranslator(ast.NodeVisitor):
         opname = primops[op_str]
         return Prim(opname, [a, b])
 
+    def record_field(self, node):
+        """Matches the access to a field of a record array, written
+        either a[i].x or a['x'][i], or of a jitclass object, obj.x.
+
+        Returns:
+            tuple: (Index of the record or object, field name), None for other nodes
+        """
+        if isinstance(node, ast.Attribute) and node.attr != "shape":
+            return self.visit(node.value), node.attr
+        if (isinstance(node, ast.Subscript) and isinstance(node.value, ast.Subscript)
+                and isinstance(node.value.slice, ast.Index)
+                and isinstance(node.value.slice.value, ast.Str)):
+            record = Index(self.visit(node.value.value), self.visit(node.slice.value))
+            return record, node.value.slice.value.s
+        return None
+
     def visit_Assign(self, node):
         targets = node.targets
 
         assert len(node.targets) == 1
-        var = node.targets[0].id
+        if self.whole(node.targets[0]):
+            target = node.targets[0].value
+            return self.fused_store(target, node.value)
         val = self.visit(node.value)
+        field = self.record_field(node.targets[0])
+        if field:
+            return SetField(field[0], field[1], val)
+        if isinstance(node.targets[0], ast.Subscript):
+            target = node.targets[0]
+            return SetIndex(self.visit(target.value), self.visit(target.slice.value), val)
+        var = node.targets[0].id
         return Assign(var, val)
 
     def visit_FunctionDef(self, node):
-        stmts = list(node.body)
-        stmts = map(self.visit, stmts)
+        stmts = map(self.visit, node.body)
         args = map(self.visit, node.args.args)
         res = Fun(node.name, args, stmts)
         return res
@@ -128,15 +260,21 @@ class CoreTranslator(ast.NodeVisitor):
         val = self.visit(node.value)
         return Return(val)
 
+    def visit_Tuple(self, node):
+        return Tuple(map(self.visit, node.elts))
+
     def visit_Attribute(self, node):
         if node.attr == "shape":
             val = self.visit(node.value)
             return Prim("shape#", [val])
         else:
-            raise NotImplementedError
+            return Field(self.visit(node.value), node.attr)
 
     def visit_Subscript(self, node):
         if isinstance(node.ctx, ast.Load):
+            field = self.record_field(node)
+            if field:
+                return Field(*field)
             if node.slice:
                 val = self.visit(node.value)
                 ix = self.visit(node.slice.value)
@@ -153,11 +291,27 @@ class CoreTranslator(ast.NodeVisitor):
             raise Exception("Loop must be over range")
 
         if len(args) == 1:   # xrange(n)
-            return Loop(target, LitInt(0, type=int32), args[0], stmts)
+            return Loop(target, LitInt(0), args[0], stmts)
         elif len(args) == 2:  # xrange(n,m)
             return Loop(target, args[0], args[1], stmts)
 
     def visit_AugAssign(self, node):
+        if self.whole(node.target):
+            target = node.target.value
+            return self.fused_store(target, ast.BinOp(target, node.op, node.value))
+        field = self.record_field(node.target)
+        if field:
+            record, name = field
+            opname = primops[node.op.__class__]
+            value = self.visit(node.value)
+            return SetField(record, name, Prim(opname, [Field(record, name), value]))
+        if isinstance(node.target, ast.Subscript):
+            target = node.target
+            opname = primops[node.op.__class__]
+            val = self.visit(target.value)
+            ix = self.visit(target.slice.value)
+            value = self.visit(node.value)
+            return SetIndex(val, ix, Prim(opname, [Index(val, ix), value]))
         if isinstance(node.op, ast.Add):
             ref = node.target.id
             value = self.visit(node.value)
@@ -1,8 +1,16 @@
 # -*- coding: utf-8 -*-
 import logging 
-import sys
+import os
+import json
+import importlib
+import threading
+import weakref
+import __builtin__
 import numpy as np
-from itertools import tee, izip
+from itertools import tee, izip, count
+from functools import partial
+from timeit import default_timer
+from concurrent.futures import ThreadPoolExecutor
 
 import llvm.core as lc
 import llvm.passes as lp
@@ -10,43 +18,248 @@ import llvm.ee as le
 
 from core_translator import CoreTranslator
 from type_inference import TypeInfer, UnderDeteremined
-from type_system import TVar, TFun, int32, int64, double64, float32
+from type_system import TVar, TFun, int64, double64, array
+from type_system import dtype_names, dump_type, load_type, boolean, TRecord, object_type
+from core_language import Alloc, SetIndex, SetField, Var, Index, Loop, Prim, Fun, Return, LitInt, Reduce
+from core_language import walk, iter_child_nodes
 from pretty_printer import dump
 from constrain_solver import ConstrainSolver 
-from llvm_codegen import determined, LLVMEmitter
-from type_mapping import mangler, wrap_module
+from llvm_codegen import determined, LLVMEmitter, no_identity
+from type_mapping import wrap_module, as_ndarray
+import runtime
+import perf
+import quality
 
 logging.basicConfig(level=logging.WARN)
 import ast
 import inspect
+from textwrap import dedent
 
 module = lc.Module.new('fastpy.module')
 engine = None
 function_cache = {}
 
+# The LLVM module and engine are shared, so only one specialization is 
+# compiled at a time. Background compilations are queued in the executor.
+compile_lock = threading.RLock()
+executor_lock = threading.Lock()
+executor = None
+_uids = count()
+# Every build gets its own symbol, the module is shared by all the functions.
+_symbols = count()
+
+# Bound on the number of specializations kept alive for all the functions,
+# the least recently used ones are evicted and their machine code released.
+max_specializations = None
+last_used = {}
+_clock = count()
+_owners = weakref.WeakValueDictionary()
+
+# Machine code of every specialization, by cache key. Replaced and evicted
+# code is retired, and freed by a later compilation once no call runs on it.
+machine_code = {}
+_retired = []
+
+# Manifest file where every compiled signature is recorded, see record().
+manifest = None
+_recorded = set()
+
+# Tiered compilation: new specializations are first compiled with a cheap 
+# pipeline and recompiled at O3 once they have been called hot_threshold times.
+quick_opt = 1
+hot_threshold = 1000
+
+# Write the symbols of the compiled specializations to /tmp/perf-<pid>.map
+# for Linux perf, see enable_perf_map().
+perf_map = os.environ.get('FASTPY_PERF_MAP') == '1'
+
+# Profile guided compilation: loops which run less than short_trip_count 
+# iterations on average don't amortize the vectorized loop and its checks.
+short_trip_count = 16
+
 tm = le.TargetMachine.new(features='', cm=le.CM_JITDEFAULT)
 eb = le.EngineBuilder.new(module)
 engine = eb.create(tm)
+le.dylib_add_symbol(runtime.allocator_symbol, runtime.allocator_address)
+le.dylib_add_symbol(runtime.size_mismatch_symbol, runtime.size_mismatch_address)
+le.dylib_add_symbol(runtime.empty_reduction_symbol, runtime.empty_reduction_address)
 
-def fast(fn):
+def fast(fn=None, background=False, tiered=False, max_specializations=None,
+         specialize_on=None, profile=False, stats=False):
     """
     Decorator which maps the function through translator, does type inference,
-    and the creates a closure which when called will automatically specialize
+    and then creates a FastFunction which when called will automatically specialize
     the function to the given argument types and compile a new version if needed.
 
     We will cache based on the arguments ( which entirely define the function )
     and whenever a similar typed argument set is passed we just lookup 
     the preJIT'd function and invoke it without recompiling.
 
+    New signatures can also be compiled ahead of time with 
+    fn.compile_async(*example_args), which returns a future.
+
+    The decorated function can be pickled, it is rebuilt from its source 
+    and the signatures compiled so far are compiled again on unpickling.
+
+    Global and closure variables are read when a specialization is compiled,
+    numbers are inlined as constants and arrays are embedded by pointer. 
+    Their values are part of the specialization key, so rebinding one of
+    them compiles a new specialization. Pickling captures their values.
+
     Args:
-        fn (function): Function which we want to decorate
+        fn (function): Function which we want to decorate, or its source
+        background (bool): Compile new specializations on a background thread
+                           and run the Python function until they are ready.
+        tiered (bool): Compile new specializations with a quick pipeline first
+                       and recompile them at O3 in the background once hot.
+        max_specializations (int): Bound on the number of specializations of 
+                       this function, the least recently used one is evicted.
+        specialize_on (list): Arguments whose values, or shapes for arrays,
+                       are compiled in as constants. Every new value compiles
+                       a new specialization, which isn't recorded in
+                       manifests or pickles.
+        profile (bool): Compile new specializations with loop trip counters
+                       and recompile them once hot with the pipeline suited 
+                       to the trip counts measured, see trip_counts().
+        stats (bool): Collect call statistics of every specialization,
+                       see runtime_stats().
     """
+    options = dict(background=background, tiered=tiered,
+                   max_specializations=max_specializations,
+                   specialize_on=specialize_on, profile=profile, stats=stats)
+    if fn is None:
+        return lambda fn: fast(fn, **options)
     # debug(dump(ast.parse(inspect.getsource(fn))))
-    core_ast = CoreTranslator().translate(fn)
+    if isinstance(fn, basestring):
+        source, fn = dedent(fn), None
+    else:
+        source = dedent(inspect.getsource(fn))
+    core_ast = CoreTranslator().translate(source)
     debug(dump(core_ast))
-    ty, mgu = typeinfer(core_ast)
+    ty, mgu, promotions, types, captured = typeinfer(core_ast)
+    fastfn = specialize(core_ast, ty, mgu, promotions, types, captured, fn, **options)
+    fastfn.source = source
+    return fastfn
+
+def pipeline(*stages, **options):
+    """
+    Fuses element kernels into a single function and a single loop over 
+    the data, so the values passed from a stage to the next stay in 
+    registers instead of going through arrays. Every stage is a decorated
+    function of an element followed by parameters, which returns the 
+    element given to the next stage, like:
+
+        @fast
+        def normalize(x, offset, scale):
+            return (x + offset) * scale
+
+    pipeline(normalize, threshold)(a, out, offset, scale, t) stores the 
+    results in out, which must have as many elements as a, and returns it.
+    With fold=True the last stage accumulates them instead, it takes the 
+    accumulator and the element and returns the new accumulator: 
+    pipeline(normalize, accumulate, fold=True)(a, acc, offset, scale) 
+    returns the accumulation. The parameters of the stages come next in 
+    order, their names are prefixed with the stage name and position.
+
+    Stages which depend on the whole array, like normalizing by its
+    maximum, can't be fused; compute what they need beforehand and pass it
+    as a parameter.
+
+    Args:
+        stages (FastFunction): Element kernels, applied in order
+        fold (bool): The last stage accumulates the elements
+        options: Keyword arguments of the decorator, for the fused function
+
+    Returns:
+        FastFunction: The fused function
+    """
+    fold = options.pop('fold', False)
+    if not stages:
+        raise ValueError("A pipeline needs at least one stage")
+    # The arguments of the pipeline aren't identifiers, stages can't shadow
+    # them or read them in place of a global.
+    ix, data, out, acc = 'pipeline.i', 'pipeline.a', 'pipeline.out', 'pipeline.acc'
+    value = ast.Subscript(ast.Name(data, ast.Load()), ast.Index(ast.Name(ix, ast.Load())), ast.Load())
+    body, params = [], []
+    for (k, stage) in enumerate(stages):
+        if fold and k == len(stages) - 1:
+            stmts, args = inline_stage(stage, k, [ast.Name(acc, ast.Load()), value], acc)
+        else:
+            result = "%s.%d" % (stage.__name__, k)
+            stmts, args = inline_stage(stage, k, [value], result)
+            value = ast.Name(result, ast.Load())
+        body += stmts
+        params += args
+    if fold:
+        outputs = [acc]
+    else:
+        outputs = [out]
+        target = ast.Subscript(ast.Name(out, ast.Load()), ast.Index(ast.Name(ix, ast.Load())), ast.Store())
+        body.append(ast.Assign([target], value))
+
+    # The loop runs over the elements of a, the size check makes sure out
+    # has as many.
+    size = Prim("size#", [Var(data)] if fold else [Var(data), Var(out)])
+    loop = Loop(Var(ix), LitInt(0), size, map(CoreTranslator().visit, body))
+    args = [Var(name) for name in [data] + outputs + params]
+    name = "_".join(stage.__name__ for stage in stages)
+    core_ast = Fun(name, args, [loop, Return(Var(outputs[0]))])
     debug(dump(core_ast))
-    return specialize(core_ast, ty, mgu)
+    ty, mgu, promotions, types, captured = typeinfer(core_ast)
+    fastfn = specialize(core_ast, ty, mgu, promotions, types, captured, **options)
+    fastfn.stages = list(stages)
+    fastfn.options = dict(fastfn.options, fold=fold)
+    # Captured variables are read from the scope of the first stage using them.
+    owners = {}
+    for stage in reversed(stages):
+        owners.update((name, stage.lookup) for name in stage.captured)
+    fastfn.lookup = lambda name: owners[name](name)
+    return fastfn
+
+class Renamer(ast.NodeTransformer):
+    """Renames the variables of a Python AST."""
+    def __init__(self, names):
+        self.names = names
+
+    def visit_Name(self, node):
+        if node.id in self.names:
+            return ast.copy_location(ast.Name(self.names[node.id], node.ctx), node)
+        return node
+
+def inline_stage(stage, k, inputs, result):
+    """
+    Body of a pipeline stage, with its variables renamed so they are unique
+    to the stage, its first arguments bound to the inputs and its returned
+    value assigned to the result.
+
+    Args:
+        stage (FastFunction): Stage decorated from its source
+        k (int): Position of the stage in the pipeline
+        inputs (list): Python AST of the values of the first arguments
+        result (str): Variable holding the returned value
+
+    Returns:
+        tuple: The statements and the names of the remaining arguments
+    """
+    if not isinstance(stage, FastFunction) or stage.source is None:
+        raise ValueError("Can't fuse %r, stages are functions decorated with fast" % stage)
+    fundef = ast.parse(stage.source).body[0]
+    returns = [node for node in ast.walk(fundef) if isinstance(node, ast.Return)]
+    if len(returns) != 1 or fundef.body[-1] is not returns[0]:
+        raise ValueError("Can't fuse %s, it must end with its only return" % stage.__name__)
+    args = [arg.id for arg in fundef.args.args]
+    if len(args) < len(inputs):
+        raise ValueError("Can't fuse %s, it must take %d arguments" % (stage.__name__, len(inputs)))
+
+    # Arguments are Param names, the other variables are Store names.
+    stored = set(node.id for node in ast.walk(fundef)
+                 if isinstance(node, ast.Name) and not isinstance(node.ctx, ast.Load))
+    names = dict((name, "%s.%d.%s" % (stage.__name__, k, name)) for name in stored)
+    body = map(Renamer(names).visit, fundef.body)
+    binds = [ast.Assign([ast.Name(names[arg], ast.Store())], value)
+             for (arg, value) in zip(args, inputs)]
+    ret = ast.Assign([ast.Name(result, ast.Store())], body[-1].value)
+    return binds + body[:-1] + [ret], [names[arg] for arg in args[len(inputs):]]
 
 def typeinfer(core_ast):
     """Infer types
@@ -55,7 +268,10 @@ def typeinfer(core_ast):
         core_ast (ast): Untyped abstract syntax tree transfromed by the core translator
     
     Returns:
-        TYPE: Description
+        tuple: The function type, the most general unifier of the equality
+               constraints, the promotion constraints which are solved
+               once the argument types are known, the types of the nodes
+               and the (name, type) of the captured variables.
     """
     infer = TypeInfer()
     ty = infer.visit(core_ast)
@@ -64,69 +280,829 @@ def typeinfer(core_ast):
     debug('infered types:'+ str(infer_ty))
     debug(mgu)
     debug(infer.constraints)
-    return (infer_ty, mgu)
+    debug(infer.promotions)
+    return (infer_ty, mgu, infer.promotions, infer.types, infer.captured)
+
+
+_dtypes = dict((np.dtype(name), ty) for (name, ty) in dtype_names.items())
 
+# Scalar types looked up by the exact type of the argument, which is the
+# common case on the hot path. NumPy scalars map to the type of their dtype,
+# several scalar types share a dtype, like longlong and int64 on Linux.
+_scalars = dict((sctype, _dtypes[np.dtype(sctype)]) for sctype in set(np.sctypeDict.values())
+                if np.dtype(sctype) in _dtypes)
+_scalars.update({bool: boolean, int: int64, long: int64, float: double64})
+
+def record_type(dtype):
+    """Record type of a structured dtype, only made of scalar fields.
+    It is kept in _dtypes along with the scalar dtypes.
+    """
+    fields = []
+    for name in dtype.names:
+        fdtype, offset = dtype.fields[name][:2]
+        if fdtype not in _dtypes or fdtype.names is not None:
+            raise Exception("Record field type not supported: %s" % fdtype)
+        fields.append((name, _dtypes[fdtype], offset))
+    ty = _dtypes[dtype] = TRecord(fields, dtype.itemsize)
+    return ty
 
 def arg_pytype(arg):
-    if isinstance(arg, np.ndarray):
-        if arg.dtype == np.dtype('int32'):
-            return array(int32)
-        elif arg.dtype == np.dtype('int64'):
-            return array(int64)
-        elif arg.dtype == np.dtype('double'):
-            return array(double64)
-        elif arg.dtype == np.dtype('float'):
-            return array(float32)
-    elif isinstance(arg, int) & (arg < sys.maxint):
-        return int64
+    ty = _scalars.get(type(arg))
+    if ty is not None:
+        if type(arg) is long and not (-2**63 <= arg < 2**63):
+            raise Exception("Integer does not fit in 64 bits: %s" % arg)
+        return ty
+    # Object type of the jitclasses, inherited by their subclasses.
+    ty = getattr(type(arg), '_fastpy_type_', None)
+    if ty is not None:
+        return ty
+    elif isinstance(arg, np.ndarray):
+        if arg.dtype in _dtypes:
+            return array(_dtypes[arg.dtype])
+        if arg.dtype.names is not None:
+            return array(record_type(arg.dtype))
+        raise Exception("Array type not supported: %s" % arg.dtype)
+    elif isinstance(arg, bool):
+        return boolean
+    elif isinstance(arg, (int, long)):
+        return arg_pytype(long(arg))
     elif isinstance(arg, float):
         return double64
-    else:
-        raise Exception("Type not supported: %s" % type(arg))
+    view = as_ndarray(arg)
+    if view is not None:
+        # Objects exposing the buffer protocol are passed without copying.
+        return arg_pytype(view)
+    raise Exception("Type not supported: %s" % type(arg))
 
-def specialize(ast, infer_ty, mgu):
-    def _wrapper(*args):
-        types = map(arg_pytype, list(args))
-        spec_ty = TFun(argtys=types, retty=TVar("$retty"))
+def as_argument(arg):
+    """Views an argument exposing the buffer protocol as an ndarray, once
+    per call, the other arguments are returned as they are."""
+    if (type(arg) in _scalars or isinstance(arg, np.ndarray)
+            or hasattr(type(arg), '_fastpy_type_')):
+        return arg
+    view = as_ndarray(arg)
+    return arg if view is None else view
+
+def jitclass(cls):
+    """
+    Class decorator, also available as fast.jitclass, for classes whose
+    __slots__ map the fields to their dtypes:
+
+        @fast.jitclass
+        class Accumulator(object):
+            __slots__ = {'total': 'float64', 'count': 'int64'}
+
+            def add(self, x):
+                self.total += x
+                self.count += 1
+                return self.total
+
+    The fields of an instance are stored in a C struct, a structured array
+    of one element, which is passed to the compiled code by pointer. The 
+    methods are compiled with fast(), and any kernel the instances are 
+    given to reads and writes their fields directly. __init__ and the 
+    special methods stay in Python. Compiled code can't create instances
+    or return them.
+
+    Args:
+        cls (type): Class to compile
+
+    Returns:
+        type: A class with the same methods, storing the fields in the struct
+    """
+    slots = cls.__dict__.get('__slots__')
+    if not isinstance(slots, dict):
+        raise TypeError("%s needs a __slots__ dict of field dtypes" % cls.__name__)
+    if '_data' in slots:
+        raise TypeError("%s can't have a field named _data" % cls.__name__)
+    dtype = np.dtype([(name, slots[name]) for name in sorted(slots)], align=True)
+    record = record_type(dtype)
+
+    namespace = dict((name, value) for (name, value) in cls.__dict__.items()
+                     if name not in slots and name not in ('__slots__', '__dict__', '__weakref__'))
+    for (name, value) in namespace.items():
+        if inspect.isfunction(value) and not (name.startswith('__') and name.endswith('__')):
+            namespace[name] = jit_method(fast(value))
+    for name in slots:
+        namespace[name] = struct_field(name)
+    namespace['__slots__'] = ('_data',)
+    def __new__(klass, *args, **kwargs):
+        self = object.__new__(klass)
+        self._data = np.zeros(1, dtype)
+        return self
+    namespace['__new__'] = __new__
+    namespace['_fastpy_type_'] = object_type(record)
+
+    return type(cls)(cls.__name__, cls.__bases__, namespace)
+
+fast.jitclass = jitclass
+
+def struct_field(name):
+    """Property reading and writing a field in the struct of the object."""
+    def get(self):
+        return self._data[name][0].item()
+    def set(self, value):
+        self._data[name] = value
+    return property(get, set)
+
+def jit_method(compiled):
+    """Method calling the compiled function with the object as first argument."""
+    def _method(self, *args):
+        return compiled(self, *args)
+    _method.__name__ = compiled.__name__
+    _method.fast = compiled
+    return _method
+
+def allocates(core_ast):
+    """Whether the function creates arrays at runtime."""
+    return any(isinstance(node, Alloc) for node in walk(core_ast))
+
+def checks_sizes(core_ast):
+    """Whether the function checks the sizes of the operands of array
+    expressions, or that reductions without an identity aren't empty, at
+    runtime."""
+    return any((isinstance(node, Prim) and node.fn == "size#" and len(node.args) > 1) or
+               (isinstance(node, Reduce) and node.fn in no_identity)
+               for node in walk(core_ast))
+
+def stored_args(core_ast):
+    """Positions of the array arguments the function stores into."""
+    stores = [node.val for node in walk(core_ast) if isinstance(node, SetIndex)]
+    stores += [node.val.val for node in walk(core_ast)
+               if isinstance(node, SetField) and isinstance(node.val, Index)]
+    stored = set(val.id for val in stores if isinstance(val, Var))
+    return [k for (k, arg) in enumerate(core_ast.args) if arg.id in stored]
+
+def check_writeable(args, positions, names):
+    for k in positions:
+        view = as_ndarray(args[k])
+        if view is not None and not view.flags.writeable:
+            raise ValueError("Argument %s is read-only" % names[k])
+
+def specialize(ast, infer_ty, mgu, promotions, types, captured, fn=None, **options):
+    return FastFunction(ast, infer_ty, mgu, promotions, types, captured, fn, **options)
+
+class FastFunction(object):
+    """
+    Callable returned by the decorator, it specializes the function to the
+    types of its arguments and compiles a new version when needed.
+    
+    Attributes:
+        ast (TYPE): Core AST of the function
+        types (dict): Types of the nodes of the core AST, before specialization
+        call_stats (dict): Call statistics of every specialization
+        captured (list): Global and closure variables read by the function
+        embedded (dict): Values of the captured variables in every specialization
+        fallback (function): Python function run while compiling in the background
+        fn (TYPE): Python function, None for functions built from their source
+        last_captured (tuple): Last values of the captured variables, and their key
+        lookup (function): Reads the current value of a captured variable
+        options (dict): Keyword arguments given to the decorator
+        profiles (dict): Loop counters of the profiled specializations
+        reports (dict): Codegen quality report of every specialization
+        source (str): Source of the function, what we pickle
+        specialize_on (list): Arguments whose values are compiled in
+        specializations (dict): Argument types of every specialization
+        stages (list): Functions fused by pipeline(), None for others
+        uid (int): Distinguishes the cache entries of functions with the same name
+    """
+    def __init__(self, ast, infer_ty, mgu, promotions, types, captured, fn=None, background=False,
+                 tiered=False, max_specializations=None, specialize_on=None,
+                 profile=False, stats=False):
+        self.ast = ast
+        self.infer_ty = infer_ty
+        self.mgu = mgu
+        self.promotions = promotions
+        self.types = types
+        self.fn = fn
+        self.fallback = fn
+        self.background = background
+        self.tiered = tiered
+        self.max_specializations = max_specializations
+        self.specialize_on = list(specialize_on or [])
+        self.profile = profile
+        self.collect_stats = stats
+        self.options = dict(background=background, tiered=tiered,
+                            max_specializations=max_specializations,
+                            specialize_on=specialize_on, profile=profile, stats=stats)
+        self.source = None
+        self.stages = None
+        self.specializations = {}
+        self.allocs = allocates(ast)
+        self.checked = checks_sizes(ast)
+        self.written = stored_args(ast)
+        self.argnames = [arg.id for arg in ast.args]
+        unknown = set(self.specialize_on) - set(self.argnames)
+        if unknown:
+            raise ValueError("Can't specialize on %s, not an argument" % ", ".join(sorted(unknown)))
+        self.value_args = map(self.argnames.index, self.specialize_on)
+        self.captured = [name for (name, _) in captured]
+        self.captured_tys = [ConstrainSolver().apply(mgu, ty) for (_, ty) in captured]
+        self.lookup = scope(fn)
+        # Last values of the captured variables and their part of the key.
+        self.last_captured = ((), ())
+        self.embedded = {}
+        self.profiles = {}
+        self.reports = {}
+        self.call_stats = {}
+        self.uid = next(_uids)
+        self.pending = {}
+        self.pending_lock = threading.Lock()
+        self.__name__ = ast.fname
+        _owners[self.uid] = self
+
+    def __call__(self, *args):
+        start = default_timer() if self.collect_stats else None
+        # Buffers are viewed as ndarrays once, the Python function gets the originals.
+        views = map(as_argument, args)
+        # The argument types are concrete, so they are the specialized types.
+        types = map(arg_pytype, views)
+        key, values = self.key(types, views)
+        if self.written:
+            check_writeable(views, self.written, self.argnames)
+        # Don't recompile after we've specialized.
+        if key in function_cache:
+            last_used[key] = next(_clock)
+            if start is not None:
+                return self.call_timed(key, start, views)
+            return function_cache[key](*views)
+        elif self.background and self.fallback is not None:
+            self.submit(key, types, values)
+            return self.fallback(*args)
+        elif start is not None:
+            # Leave the compilation out of the statistics.
+            self.compile(key, types, values)
+            return self.call_timed(key, default_timer(), views)
+        else:
+            return self.compile(key, types, values)(*views)
+
+    def stream(self, chunks, state=None, prefetch=False):
+        """
+        Runs the function over an iterator of chunks, such as the slices of
+        a memmap or blocks read from a file. The function takes a chunk, 
+        or the arrays of a tuple, followed by the state and returns the new
+        state, as a tuple for several values. Scans can write their results
+        into the chunks and carry the last value in the state.
+
+        Args:
+            chunks (iterable): Arrays, or tuples of arrays
+            state (TYPE): Initial state, None for functions without one
+            prefetch (bool): Fetch the next chunk on another thread while 
+                             the compiled code runs on the current one
+
+        Returns:
+            TYPE: The final state, or the list of results without a state
+        """
+        results = []
+        for chunk in (prefetched(chunks) if prefetch else chunks):
+            args = list(chunk) if isinstance(chunk, tuple) else [chunk]
+            if state is None:
+                results.append(self(*args))
+            elif isinstance(state, tuple):
+                state = self(*(args + list(state)))
+            else:
+                state = self(*(args + [state]))
+        return results if state is None else state
+
+    def call_timed(self, key, start, args):
+        result = function_cache[key](*args)
+        nbytes = 0
+        for arg in args:
+            view = None if isinstance(arg, (int, long, float)) else as_ndarray(arg)
+            if view is not None:
+                nbytes += view.nbytes
+        self.call_stats[key].record(default_timer() - start, nbytes)
+        return result
+
+    def runtime_stats(self):
+        """
+        Call statistics of the specializations compiled with stats=True,
+        since they were compiled or reset. Times are in seconds, dispatch_time
+        is the part of the time spent outside native code.
+
+        Returns:
+            dict: Statistics indexed by the argument types
+        """
+        merged = {}
+        for (key, stats) in self.call_stats.items():
+            if key in self.specializations:
+                signature = tuple(self.specializations[key])
+                merged.setdefault(signature, runtime.CallStats()).merge(stats)
+        return dict((signature, stats.as_dict()) for (signature, stats) in merged.items())
+
+    def reset_runtime_stats(self):
+        for stats in self.call_stats.values():
+            stats.reset()
+
+    def __reduce__(self):
+        signatures = [] if self.specialize_on else self.signatures
+        if self.stages is not None:
+            return (rebuild_pipeline, (self.stages, self.options, signatures))
+        return (rebuild, (self.source, self.options, signatures, self.constants()))
+
+    def key(self, types, args=None):
+        """
+        Specialization key of the argument types, of the current values of
+        the captured variables and of the arguments specialized on. 
+        Captured arrays are identified by the object, which is kept alive 
+        by the specialization embedding it.
+
+        Returns:
+            tuple: The key and the values of the captured variables
+        """
+        key = (self.uid, tuple(types))
+        values = []
+        if self.captured:
+            values = map(self.lookup, self.captured)
+            # Typing the values is only needed after a variable is rebound.
+            last, consts = self.last_captured
+            if len(values) != len(last) or any(a is not b for (a, b) in izip(values, last)):
+                consts = tuple((arg_pytype(val), val if type(val) in _scalars else id(val))
+                               for val in values)
+                self.last_captured = (values, consts)
+            key += (consts,)
+        if self.specialize_on:
+            if args is None:
+                raise ValueError("%s is specialized on argument values" % self.__name__)
+            key += (tuple(specialized_value(args[k]) for k in self.value_args),)
+        return key, values
+
+    def constants(self):
+        """Current values of the captured variables which are defined."""
+        consts = {}
+        for name in self.captured:
+            try:
+                consts[name] = self.lookup(name)
+            except NameError:
+                pass
+        return consts
+
+    @property
+    def signatures(self):
+        """Argument types of the compiled specializations."""
+        return [self.specializations[key] for key in sorted(self.specializations)]
+
+    def resolve(self, types, values=()):
+        # Captured variables are typed like extra arguments.
+        infer_ty = TFun(self.infer_ty.argtys + self.captured_tys, self.infer_ty.retty)
+        spec_ty = TFun(argtys=types + map(arg_pytype, values), retty=TVar("$retty"))
         unifier = ConstrainSolver().unify(infer_ty, spec_ty)
-        specializer = ConstrainSolver().compose(unifier, mgu)
+        specializer = ConstrainSolver().compose(unifier, self.mgu)
+        specializer = ConstrainSolver().promote(specializer, self.promotions)
 
         retty = ConstrainSolver().apply(specializer, TVar("$retty"))
         argtys = [ConstrainSolver().apply(specializer, ty) for ty in types]
         debug('Specialized Function:' + str(TFun(argtys, retty)))
 
         if determined(retty) and all(map(determined, argtys)):
-            key = mangler(ast.fname, argtys)
-            # Don't recompile after we've specialized.
+            return (specializer, retty, argtys)
+        else:
+            raise UnderDeteremined()
+
+    def build(self, key, types, opt, counters=None, **passes):
+        values = self.embedded.get(key, [])
+        specializer, retty, argtys = self.resolve(types, values)
+        constants = [(name, ConstrainSolver().apply(specializer, ty), val)
+                     for (name, ty, val) in zip(self.captured, self.captured_tys, values)]
+        # The values specialized on are the last part of the key.
+        specialized = dict(zip(self.specialize_on, key[-1])) if self.specialize_on else {}
+        report = dict(opt=opt)
+        global_vars = []
+        name = "%s_%d_%d" % (self.ast.fname, self.uid, next(_symbols))
+        llfunc = codegen(self.ast, self.types, specializer, retty, argtys, name, opt,
+                         constants, specialized, counters, report=report,
+                         global_vars=global_vars, **passes)
+        self.reports[key] = report
+        stats = self.call_stats.setdefault(key, runtime.CallStats()) if self.collect_stats else None
+        pyfunc = wrap_module(argtys, llfunc, engine, retty, self.allocs, stats, self.checked)
+        if perf_map:
+            write_perf_entry(self, llfunc, argtys)
+        code = machine_code[key] = runtime.MachineCode(llfunc, (values, counters),
+                                                             global_vars)
+        return code.guard(pyfunc, partial(redispatch, key))
+
+    @property
+    def llfuncs(self):
+        """LLVM function of every specialization."""
+        return dict((key, code.llfunc) for (key, code) in machine_code.items()
+                    if key[0] == self.uid)
+
+    def compile(self, key, types, values=()):
+        with compile_lock:
+            # Publishing the entry swaps in the compiled code atomically.
             if key in function_cache:
-                return function_cache[key](*args)
+                return function_cache[key]
+            self.embedded[key] = list(values)
+            if self.profile:
+                # Two counters per loop, how many times it starts and iterates.
+                counters = np.zeros(2 * len(loops(self.ast)), dtype=np.int64)
+                self.profiles[key] = counters
+                pyfunc = self.build(key, types, quick_opt, counters)
+                pyfunc = self.count_calls(key, types, pyfunc)
+            elif self.tiered:
+                pyfunc = self.count_calls(key, types, self.build(key, types, quick_opt))
             else:
-                llfunc = codegen(ast, specializer, retty, argtys)
-                pyfunc = wrap_module(argtys, llfunc, engine)
-                function_cache[key] = pyfunc
-                return pyfunc(*args)
+                pyfunc = self.build(key, types, 3)
+            function_cache[key] = pyfunc
+            last_used[key] = next(_clock)
+            self.specializations[key] = types
+            record_signature(self, types)
+            evict_lru(self, key)
+            collect()
+            return pyfunc
+
+    def precompile(self, types):
+        """Compiles the specialization for the given argument types."""
+        key, values = self.key(types)
+        return self.compile(key, types, values)
+
+    def count_calls(self, key, types, pyfunc):
+        calls = [0]
+        def _counted(*args):
+            calls[0] += 1
+            if calls[0] == hot_threshold:
+                future = background_executor().submit(self.optimize, key, types)
+                future.add_done_callback(_log_failure)
+            return pyfunc(*args)
+        return _counted
+
+    def optimize(self, key, types):
+        with compile_lock:
+            if key in function_cache:
+                stale = machine_code[key]
+                function_cache[key] = self.build(key, types, **self.tuning(key))
+                # Calls may still be running on the quick tier.
+                retire(stale)
+
+    def tuning(self, key):
+        """
+        Optimization pipeline of a hot specialization. Without a profile it 
+        is O3 with the loop vectorizer. When every loop of the profile is 
+        short, the vectorizer and its runtime checks are left out; when 
+        some loop is long, the SLP vectorizer is added as well.
+        """
+        trips = trip_counts(self.profiles[key]) if key in self.profiles else []
+        if not trips or all(t is None for t in trips):
+            return dict(opt=3)
+        elif max(trips) < short_trip_count:
+            return dict(opt=2, loop_vectorize=False)
+        return dict(opt=3, loop_vectorize=True, vectorize=True)
+
+    def trip_counts(self):
+        """
+        Average number of iterations of every loop, in the order of the 
+        source, measured for each specialization compiled with profile=True.
+
+        Returns:
+            dict: Lists of trip counts indexed by the argument types, None 
+                  for the loops which never ran
+        """
+        return dict((tuple(self.specializations[key]), trip_counts(counters))
+                    for (key, counters) in self.profiles.items()
+                    if key in self.specializations)
+
+    def codegen_report(self):
+        """
+        Quality of the code generated for every specialization, by its last
+        compilation: opt level, instructions and basic blocks before and
+        after optimization, allocas left, the loops with the vector width
+        chosen and the loads and stores in their body, and the calls which
+        weren't inlined. See quality.report().
+
+        Returns:
+            dict: Reports indexed by the argument types
+        """
+        return dict((tuple(self.specializations[key]), report)
+                    for (key, report) in self.reports.items()
+                    if key in self.specializations)
+
+    def evict(self, key):
+        """
+        Drops a specialization, releasing its machine code and LLVM function
+        once no call runs on it anymore.
+        """
+        with compile_lock:
+            function_cache.pop(key, None)
+            last_used.pop(key, None)
+            self.specializations.pop(key, None)
+            self.pending.pop(key, None)
+            self.embedded.pop(key, None)
+            self.profiles.pop(key, None)
+            self.reports.pop(key, None)
+            self.call_stats.pop(key, None)
+            retire(machine_code.pop(key, None))
+
+    def submit(self, key, types, values=()):
+        with self.pending_lock:
+            if key not in self.pending:
+                self.pending[key] = background_executor().submit(self.compile, key, types, values)
+                self.pending[key].add_done_callback(_log_failure)
+            return self.pending[key]
+
+    def compile_async(self, *args):
+        types = map(arg_pytype, list(args))
+        key, values = self.key(types, args)
+        return self.submit(key, types, values)
+
+def loops(core_ast):
+    """Loops of the function, in the order the emitter numbers them."""
+    found = []
+    def visit(node):
+        if isinstance(node, Loop):
+            found.append(node)
+        for child in iter_child_nodes(node):
+            visit(child)
+    visit(core_ast)
+    return found
+
+def trip_counts(counters):
+    entries, iterations = counters[0::2], counters[1::2]
+    return [float(n) / e if e else None for (e, n) in zip(entries, iterations)]
+
+_exhausted = object()
+
+def prefetched(iterable):
+    """Iterates while the next item is fetched on another thread, the
+    compiled code releases the GIL."""
+    items = iter(iterable)
+    fetcher = ThreadPoolExecutor(max_workers=1)
+    try:
+        pending = fetcher.submit(next, items, _exhausted)
+        while True:
+            item = pending.result()
+            if item is _exhausted:
+                return
+            pending = fetcher.submit(next, items, _exhausted)
+            yield item
+    finally:
+        fetcher.shutdown(wait=True)
+
+def specialized_value(arg):
+    """Value of an argument specialized on, the shape for arrays."""
+    view = None if isinstance(arg, (int, long, float, np.generic)) else as_ndarray(arg)
+    if view is not None:
+        return view.shape
+    elif arg != arg:
+        # NaN isn't equal to itself, it would never find its specialization.
+        return 'nan'
+    return arg
+
+def scope(fn=None, constants=None):
+    """
+    Looks up the variables a function reads from its closure, its globals
+    and the builtins, as Python would. Functions rebuilt from their source
+    only see the constants given.
+
+    Returns:
+        function: Lookup of a name, raising NameError if it is undefined
+    """
+    cells, namespaces = {}, [constants or {}]
+    if fn is not None:
+        cells = dict(zip(fn.func_code.co_freevars, fn.func_closure or ()))
+        namespaces = [fn.func_globals, vars(__builtin__)]
+    def lookup(name):
+        if name in cells:
+            return cells[name].cell_contents
+        for namespace in namespaces:
+            if name in namespace:
+                return namespace[name]
+        raise NameError("name '%s' is not defined" % name)
+    return lookup
+
+def release(code):
+    """Frees the machine code of a specialization, then deletes its function
+    and the global variables it used from the module."""
+    engine.free_machine_code_for(code.llfunc)
+    code.llfunc.delete()
+    for gv in code.global_vars:
+        gv.delete()
+
+def retire(code):
+    """Retires the machine code of a specialization which was replaced or
+    evicted, it is freed once the calls running on it have returned. The
+    cache entry must be updated first, calls arriving late dispatch again."""
+    if code is not None:
+        code.retired = True
+        _retired.append(code)
+    collect()
+
+def collect():
+    """Frees the retired machine code no call is running on anymore."""
+    with compile_lock:
+        for code in list(_retired):
+            if not code.calls:
+                _retired.remove(code)
+                release(code)
+
+def redispatch(key, *args):
+    """Calls the current specialization of a key, for a call which reached
+    retired machine code."""
+    owner = _owners.get(key[0])
+    if owner is None:
+        raise RuntimeError("The specialization was evicted and its function collected")
+    return owner(*args)
+
+def evict_lru(fastfn, current):
+    """Evicts the least recently used specializations, other than the one 
+    just compiled, until both the bound of the function and the global 
+    bound are satisfied."""
+    while (fastfn.max_specializations is not None and
+           len(fastfn.specializations) > max(fastfn.max_specializations, 1)):
+        candidates = [key for key in fastfn.specializations if key != current]
+        fastfn.evict(min(candidates, key=last_used.get))
+    while (max_specializations is not None and
+           len(function_cache) > max(max_specializations, 1)):
+        candidates = [key for key in function_cache if key != current]
+        key = min(candidates, key=last_used.get)
+        owner = _owners.get(key[0])
+        if owner is not None:
+            owner.evict(key)
         else:
-            raise UnderDeteremined()
-    return _wrapper
+            function_cache.pop(key, None)
+            last_used.pop(key, None)
+            retire(machine_code.pop(key, None))
+
+def jit_footprint():
+    """
+    Size of the JIT'd code kept alive.
+
+    Returns:
+        dict: Number of specializations, of functions and global variables
+              in the LLVM module and of LLVM instructions in the functions.
+    """
+    with compile_lock:
+        functions = [f for f in module.functions if not f.is_declaration]
+        instructions = sum(len(bb.instructions) for f in functions for bb in f.basic_blocks)
+        return dict(specializations=len(function_cache),
+                    functions=len(functions),
+                    globals=len(list(module.global_variables)),
+                    instructions=instructions)
 
+def record(path):
+    """
+    Records the signature of every specialization compiled from now on in
+    a manifest file, one JSON object per line. warmup() replays it to 
+    precompile the same specializations when a new process starts.
+
+    Args:
+        path (str): Manifest file, new entries are appended to it.
+    """
+    global manifest
+    manifest = path
+
+def enable_perf_map(enabled=True):
+    """
+    Writes the address, size and name of every specialization compiled from
+    now on to /tmp/perf-<pid>.map, so Linux perf can attribute the samples
+    of JIT'd code. Also enabled by the FASTPY_PERF_MAP=1 environment variable.
+    """
+    global perf_map
+    perf_map = enabled
 
+def write_perf_entry(fastfn, llfunc, types):
+    # Only the new function is compiled to an object, the module grows with
+    # every specialization. Removing the other ones from a copy of the IR is
+    # much cheaper than generating their machine code again.
+    single = module.clone()
+    for other in list(single.functions):
+        if not other.is_declaration and other.name != llfunc.name:
+            other.delete()
+    sizes = perf.symbol_sizes(tm.emit_object(single))
+    if llfunc.name not in sizes:
+        logging.warning('No symbol size for %s, not added to the perf map', llfunc.name)
+        return
+    name = "%s(%s)" % (fastfn.__name__, ", ".join(map(str, types)))
+    if fastfn.fn is not None:
+        code = fastfn.fn.func_code
+        name += " [%s:%d]" % (code.co_filename, code.co_firstlineno)
+    address = engine.get_pointer_to_function(llfunc)
+    perf.write_entry(address, sizes[llfunc.name], name)
 
-def codegen(ast, specializer, retty, argtys):
-    cgen = LLVMEmitter(module, specializer, retty, argtys)
+def record_signature(fastfn, types):
+    # Functions rebuilt from their source can't be found by name, and the
+    # manifest only holds types.
+    if manifest is None or fastfn.fn is None or fastfn.specialize_on:
+        return
+    entry = json.dumps(dict(module=fastfn.fn.__module__,
+                            function=fastfn.fn.__name__,
+                            signature=map(dump_type, types)), sort_keys=True)
+    if (manifest, entry) not in _recorded:
+        _recorded.add((manifest, entry))
+        with open(manifest, 'a') as f:
+            f.write(entry + '\n')
+
+def warmup(path, background=False):
+    """
+    Precompiles the specializations recorded in a manifest by record().
+
+    The compiled code lives in the JIT of this process, so compilation can't
+    be spread over other processes; use background=True to warm up on the 
+    background thread while the rest of the service starts.
+
+    Args:
+        path (str): Manifest file
+        background (bool): Return a future instead of waiting
+
+    Returns:
+        int: Number of specializations compiled
+    """
+    if background:
+        return background_executor().submit(warmup, path)
+    with open(path) as f:
+        entries = set(line.strip() for line in f if line.strip())
+    compiled = 0
+    for entry in sorted(entries):
+        entry = json.loads(entry)
+        fastfn = getattr(importlib.import_module(entry['module']), entry['function'], None)
+        if not isinstance(fastfn, FastFunction):
+            logging.warning('Skipping %s.%s, not a @fast function at module level',
+                            entry['module'], entry['function'])
+            continue
+        fastfn.precompile(map(load_type, entry['signature']))
+        compiled += 1
+    return compiled
+
+def rebuild(source, options, signatures, constants=None):
+    """Unpickles a decorated function and compiles the signatures it had."""
+    fastfn = fast(source, **options)
+    fastfn.lookup = scope(constants=constants)
+    if fastfn.background:
+        fastfn.fallback = python_function(source, constants or {})
+    for types in signatures:
+        fastfn.precompile(types)
+    return fastfn
+
+def python_function(source, constants):
+    """
+    Python function of a source without its decorators, which runs while
+    the new specializations of an unpickled function are compiled in the
+    background. It sees the captured variables and NumPy, like the
+    compiled code.
+    """
+    tree = ast.parse(source)
+    tree.body[0].decorator_list = []
+    namespace = dict(constants, np=np, numpy=np)
+    exec compile(tree, '<fastpy>', 'exec') in namespace
+    return namespace[tree.body[0].name]
+
+def rebuild_pipeline(stages, options, signatures):
+    """Unpickles a pipeline, its stages carry their captured variables."""
+    fastfn = pipeline(*stages, **options)
+    for types in signatures:
+        fastfn.precompile(types)
+    return fastfn
+
+def background_executor():
+    global executor
+    with executor_lock:
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers=1)
+        return executor
+
+def _log_failure(future):
+    if future.exception() is not None:
+        logging.warning('Background compilation failed: %s', future.exception())
+
+def codegen(ast, types, specializer, retty, argtys, name, opt=3, constants=(),
+            specialized=None, counters=None, loop_vectorize=True, vectorize=False,
+            report=None, global_vars=None):
+    """Emits and optimizes the LLVM function of a specialization, the codegen
+    quality report of the function is written into report and the global
+    variables it created are appended to global_vars when given."""
+    cgen = LLVMEmitter(module, specializer, types, retty, argtys, name, constants, specialized,
+                       counters)
     mod = cgen.visit(ast)
     cgen.function.verify()
+    before = quality.counts(cgen.function)
 
-    tm = le.TargetMachine.new(opt=3, cm=le.CM_JITDEFAULT, features='')
-    pms = lp.build_pass_managers(tm=tm,
-                                 fpm=False,
-                                 mod=module,
-                                 opt=3,
-                                 vectorize=False,
-                                 loop_vectorize=True)
-    pms.pm.run(module)
+    tm = le.TargetMachine.new(opt=opt, cm=le.CM_JITDEFAULT, features='')
+    if opt >= 2:
+        pms = lp.build_pass_managers(tm=tm,
+                                     fpm=False,
+                                     mod=module,
+                                     opt=opt,
+                                     vectorize=vectorize,
+                                     loop_vectorize=loop_vectorize)
+        pms.pm.run(module)
+    else:
+        # Quick tier, only run the function passes on the new function.
+        pms = lp.build_pass_managers(tm=tm,
+                                     fpm=True,
+                                     mod=module,
+                                     opt=opt,
+                                     vectorize=False,
+                                     loop_vectorize=False)
+        pms.fpm.initialize()
+        pms.fpm.run(cgen.function)
+        pms.fpm.finalize()
 
+    if report is not None:
+        report.update(quality.report(cgen.function, before))
+    if global_vars is not None:
+        global_vars.extend(cgen.global_vars)
     debug(cgen.function)
-    debug(module.to_native_assembly())
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        debug(module.to_native_assembly())
     return cgen.function
 
 def debug(fmt, *args):
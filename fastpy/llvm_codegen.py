@@ -14,13 +14,24 @@ struct ndarray_double {
     shape *int;
 }
 
+LLVM integers are signless, so the signed and unsigned variants of
+an integer type share the same LLVM type and only differ in the
+conversion instructions we emit for them. Booleans are stored as
+bytes, like NumPy does.
+
 Attributes:
     bool_type (TYPE): Description
+    byte_type (TYPE): Description
     double_array (TYPE): Description
     double_type (TYPE): Description
+    float_array (TYPE): Description
     float_type (TYPE): Description
+    int16_array (TYPE): Description
+    int16_type (TYPE): Description
     int32_array (TYPE): Description
     int64_array (TYPE): Description
+    int64_type (TYPE): Description
+    int8_array (TYPE): Description
     int_type (TYPE): Description
     lltypes_map (TYPE): Description
     pointer (TYPE): Description
@@ -32,11 +43,19 @@ from collections import defaultdict
 import llvm.core as lc
 from llvm.core import Module, Builder, Function, Type, Constant
 
-from type_system import int32, int64, double64, float32, array_int32, array_int64, array_double64, ftv, is_array , TVar, TCon
-from type_mapping import mangler
+from type_system import int32, int64, double64, float32, array_int32, array_int64, array_double64, ftv, is_array
+from type_system import boolean, int8, uint8, int16, uint16, array_bool, array_int8, array_uint8, array_int16, array_uint16, array_float32
+from type_system import is_integer, is_unsigned, is_float, TTuple, TRecord, is_object
+from type_mapping import as_ndarray
+from core_language import Var, Prim, Index
+from constrain_solver import ConstrainSolver
+from runtime import allocator_symbol, size_mismatch_symbol, empty_reduction_symbol
 
 pointer     = Type.pointer
+byte_type   = Type.int(8)
+int16_type  = Type.int(16)
 int_type    = Type.int()
+int64_type  = Type.int(64)
 float_type  = Type.float()
 double_type = Type.double()
 bool_type   = Type.int(1)
@@ -50,23 +69,96 @@ def array_type(elt_type):
         pointer(int_type),  # shape
     ], name='ndarray_' + str(elt_type))
 
+int8_array = pointer(array_type(byte_type))
+int16_array = pointer(array_type(int16_type))
 int32_array = pointer(array_type(int_type))
-int64_array = pointer(array_type(Type.int(64)))
+int64_array = pointer(array_type(int64_type))
+float_array = pointer(array_type(float_type))
 double_array = pointer(array_type(double_type))
 
 lltypes_map = {
+    boolean        : byte_type,
+    int8           : byte_type,
+    uint8          : byte_type,
+    int16          : int16_type,
+    uint16         : int16_type,
     int32          : int_type,
-    int64          : int_type,
+    int64          : int64_type,
     float32        : float_type,
     double64       : double_type,
+    array_bool     : int8_array,
+    array_int8     : int8_array,
+    array_uint8    : int8_array,
+    array_int16    : int16_array,
+    array_uint16   : int16_array,
     array_int32    : int32_array,
     array_int64    : int64_array,
+    array_float32  : float_array,
     array_double64 : double_array
 }
 
+# Size in bytes of the scalar types.
+itemsizes = {
+    boolean  : 1,
+    int8     : 1,
+    uint8    : 1,
+    int16    : 2,
+    uint16   : 2,
+    int32    : 4,
+    int64    : 8,
+    float32  : 4,
+    double64 : 8
+}
+
+# Independent accumulators of the reductions.
+accumulators = 4
+
+# Reductions without an identity, which raise on empty arrays.
+no_identity = ("min#", "max#", "argmin#", "argmax#")
+
+# Fields of the ndarray struct.
+array_fields = {'data': 0, 'dims': 1, 'shape': 2}
+
 def to_lltype(ptype):
+    if isinstance(ptype, TTuple):
+        return Type.struct(map(to_lltype, ptype.types))
+    if isinstance(ptype, TRecord):
+        return record_layout(ptype)[0]
+    if ptype not in lltypes_map and is_array(ptype) and isinstance(ptype.b, TRecord):
+        # Struct types are named, build the one of every record array once.
+        lltypes_map[ptype] = pointer(array_type(to_lltype(ptype.b)))
+    if ptype not in lltypes_map and is_object(ptype):
+        lltypes_map[ptype] = pointer(to_lltype(ptype.b))
     return lltypes_map[ptype]
 
+def record_layout(record):
+    """Packed struct with the exact layout of a NumPy record, the gaps
+    left by the alignment of the fields are filled with byte arrays.
+
+    Args:
+        record (TRecord): Record type
+
+    Returns:
+        tuple: (LLVM type, index of every field in the struct)
+    """
+    elems, index, pos = [], {}, 0
+    for (name, ty, offset) in sorted(record.fields, key=lambda field: field[2]):
+        if offset < pos:
+            raise NotImplementedError("Overlapping record fields")
+        if offset > pos:
+            elems.append(Type.array(byte_type, offset - pos))
+        index[name] = len(elems)
+        elems.append(to_lltype(ty))
+        pos = offset + itemsizes[ty]
+    if record.itemsize > pos:
+        elems.append(Type.array(byte_type, record.itemsize - pos))
+    return Type.packed_struct(elems), index
+
+def sizeof(lltype):
+    """Size in bytes of a LLVM type as a constant expression."""
+    null = Constant.null(pointer(lltype))
+    return null.gep([Constant.int(int_type, 1)]).ptrtoint(int64_type)
+
 def determined(ty):
     return len(ftv(ty)) == 0
 
@@ -83,23 +175,44 @@ class LLVMEmitter(object):
                        all NumPy array arguments and their metadata.
         block (TYPE): Description
         builder (TYPE): LLVM Builder
+        captured (list): (name, type, value) of the global and closure variables
+        constants (dict): Constants the captured numbers are inlined as
+        entry_block (TYPE): Entry block, where all the stack slots are allocated
         exit_block (TYPE): Exit block
         function (TYPE): LLVM Function
         locals (dict): Local variables
         module (TYPE): Description
+        name (str): Symbol of the function, unique in the module
+        retptr (TYPE): Struct where tuples are returned
         retty (TYPE): Return type
         spec_types (TYPE): Type specialization
+        types (dict): Types of the nodes, given by type inference
+        specialized (dict): Values, or shapes for arrays, of the arguments 
+                            compiled in as constants
+        counters (TYPE): Int64 NumPy array where every loop counts how many 
+                         times it starts and iterates, None not to profile
     """
-    def __init__(self, module, spec_types, retty, argtys):
+    def __init__(self, module, spec_types, types, retty, argtys, name, captured=(),
+                 specialized=None, counters=None):
         self.module = module
         self.function = None            
         self.builder = None             
         self.locals = {}
         self.arrays = defaultdict(dict) 
+        self.entry_block = None
         self.exit_block = None 
+        self.retptr = None
         self.spec_types = spec_types
+        self.types = types
         self.retty = retty
         self.argtys = argtys 
+        self.name = name
+        self.captured = captured
+        self.constants = {}
+        self.specialized = specialized or {}
+        self.counters = counters
+        self.loops = 0
+        self.global_vars = []
 
     def start_function(self, name, rettype, argtypes):
         """
@@ -120,6 +233,7 @@ class LLVMEmitter(object):
         function = lc.Function.new(self.module, func_type, name)
         entry_block = function.append_basic_block("entry")
         builder = lc.Builder.new(entry_block)
+        self.entry_block = entry_block
         self.exit_block = function.append_basic_block("exit")
         self.function = function
         self.builder = builder
@@ -157,12 +271,42 @@ class LLVMEmitter(object):
         self.block = block
         self.builder.position_at_end(block)
 
+    def alloca(self, lltype, name=''):
+        """
+        Allocates a stack slot at the beginning of the entry block, whatever
+        block we are emitting code into. Only allocas in the entry block are
+        promoted to SSA registers by mem2reg.
+        
+        Args:
+            lltype (TYPE): Description
+            name (str): Description
+        
+        Returns:
+            TYPE: Pointer to the slot
+        """
+        builder = lc.Builder.new(self.entry_block)
+        builder.position_at_beginning(self.entry_block)
+        return builder.alloca(lltype, name=name)
+
     def cbranch(self, cond, true_block, false_block):
         self.builder.cbranch(cond, true_block, false_block)
 
     def branch(self, next_block):
         self.builder.branch(next_block)
 
+    def typeof(self, val):
+        """
+        Looks up the type of the subexpression in the side table
+        and applies the type specialization to it.
+        
+        Args:
+            val (TYPE): Description
+        
+        Returns:
+            TYPE: Description
+        """
+        return ConstrainSolver().apply(self.spec_types, self.types[val])
+
     def specialize(self, val):
         """
         Extracts the type of the subexpression from the AST
@@ -174,12 +318,62 @@ class LLVMEmitter(object):
         Returns:
             TYPE: Description
         """
-        if isinstance(val.type, TVar):
-            return to_lltype(self.spec_types[val.type.s])
-        elif isinstance(val.type, TCon):
-            return to_lltype(val.type)
+        return to_lltype(self.typeof(val))
+
+    def coerce(self, val, src, dst):
+        """
+        Emits the conversion of a value between two numeric types
+        of the promotion lattice.
+        
+        Args:
+            val (TYPE): LLVM value
+            src (TYPE): Type of the value
+            dst (TYPE): Type to convert to
+        
+        Returns:
+            TYPE: LLVM value of type dst
+        """
+        if src == dst:
+            return val
+        lltype = to_lltype(dst)
+        if isinstance(src, TTuple) and isinstance(dst, TTuple):
+            agg = Constant.undef(lltype)
+            for (k, (eltsrc, eltdst)) in enumerate(zip(src.types, dst.types)):
+                elt = self.builder.extract_value(val, k)
+                elt = self.coerce(elt, eltsrc, eltdst)
+                agg = self.builder.insert_value(agg, elt, k)
+            return agg
+        elif dst == boolean:
+            # Any non zero value is true.
+            if is_float(src):
+                zero = Constant.real(val.type, 0)
+                cond = self.builder.fcmp(lc.FCMP_ONE, val, zero)
+            else:
+                zero = Constant.int(val.type, 0)
+                cond = self.builder.icmp(lc.ICMP_NE, val, zero)
+            return self.builder.zext(cond, lltype)
+        elif is_integer(src) and is_integer(dst):
+            if lltype.width > val.type.width:
+                if is_unsigned(src):
+                    return self.builder.zext(val, lltype)
+                return self.builder.sext(val, lltype)
+            elif lltype.width < val.type.width:
+                return self.builder.trunc(val, lltype)
+            return val
+        elif is_integer(src) and is_float(dst):
+            if is_unsigned(src):
+                return self.builder.uitofp(val, lltype)
+            return self.builder.sitofp(val, lltype)
+        elif is_float(src) and is_integer(dst):
+            if is_unsigned(dst):
+                return self.builder.fptoui(val, lltype)
+            return self.builder.fptosi(val, lltype)
+        elif is_float(src) and is_float(dst):
+            if dst == double64:
+                return self.builder.fpext(val, lltype)
+            return self.builder.fptrunc(val, lltype)
         else:
-            return val.type
+            raise TypeError("Can't convert %s to %s" % (src, dst))
 
     def const(self, val):
         if isinstance(val, (int, long)):
@@ -194,18 +388,18 @@ class LLVMEmitter(object):
             raise NotImplementedError
 
     def visit_LitInt(self, node):
-        ty = self.specialize(node)
-        if ty is double_type:
-            return Constant.real(double_type, node.n)
-        elif ty == int_type:
-            return Constant.int(int_type, node.n)
+        ty = self.typeof(node)
+        if is_float(ty):
+            return Constant.real(to_lltype(ty), node.n)
+        else:
+            return Constant.int(to_lltype(ty), node.n)
 
     def visit_LitFloat(self, node):
-        ty = self.specialize(node)
-        if ty is double_type:
-            return Constant.real(double_type, node.n)
-        elif ty == int_type:
-            return Constant.int(int_type, node.n)
+        ty = self.typeof(node)
+        if is_float(ty):
+            return Constant.real(to_lltype(ty), node.n)
+        else:
+            return Constant.int(to_lltype(ty), node.n)
 
     def visit_Noop(self, node):
         pass
@@ -213,11 +407,19 @@ class LLVMEmitter(object):
     def visit_Fun(self, node):
         rettype = to_lltype(self.retty)
         argtypes = map(to_lltype, self.argtys)
-        # Create a unique specialized name
-        func_name = mangler(node.fname, self.argtys)
-        self.start_function(func_name, rettype, argtypes)
-
-        for (ar, llarg, argty) in zip(node.args, self.function.args, self.argtys):
+        if isinstance(self.retty, TTuple):
+            # Tuples are written to a struct the caller passes as first argument.
+            argtypes = [pointer(rettype)] + argtypes
+            rettype = void_type
+        self.start_function(self.name, rettype, argtypes)
+
+        llargs = self.function.args
+        if isinstance(self.retty, TTuple):
+            self.retptr = llargs[0]
+            self.retptr.name = 'retptr'
+            llargs = llargs[1:]
+
+        for (ar, llarg, argty) in zip(node.args, llargs, self.argtys):
             name = ar.id
             llarg.name = name
 
@@ -236,38 +438,274 @@ class LLVMEmitter(object):
                 self.arrays[name]['data'] = self.builder.load(data)
                 self.arrays[name]['dims'] = self.builder.load(dims)
                 self.arrays[name]['shape'] = self.builder.load(shape)
+                if name in self.specialized:
+                    dims, shape = self.constant_shape(name, self.specialized[name])
+                    self.arrays[name]['dims'] = dims
+                    self.arrays[name]['shape'] = shape
                 self.locals[name] = llarg
             else:
-                argref = self.builder.alloca(to_lltype(argty))
-                self.builder.store(llarg, argref)
+                # The local copy may be wider than the argument itself.
+                ty = self.typeof(ar)
+                argref = self.alloca(to_lltype(ty), name=name)
+                if name in self.specialized:
+                    llarg = self.constant(self.specialized[name], argty)
+                self.builder.store(self.coerce(llarg, argty, ty), argref)
                 self.locals[name] = argref
 
+        for (name, ty, val) in self.captured:
+            self.embed(name, ty, val)
+
         # Setup the register for return type.
         if rettype is not void_type:
-            self.locals['retval'] = self.builder.alloca(rettype, name="retval")
+            self.locals['retval'] = self.alloca(rettype, name="retval")
 
         map(self.visit, node.body)
         self.end_function()
 
+    def array_field(self, node, field):
+        """Loads a field of the ndarray struct of an array valued expression.
+        
+        Args:
+            node (TYPE): Array expression
+            field (str): One of 'data', 'dims' or 'shape'
+        
+        Returns:
+            TYPE: LLVM value
+        """
+        if isinstance(node, Var) and node.id in self.arrays:
+            return self.arrays[node.id][field]
+        elif isinstance(node, Prim) and node.fn == "shape#" and field == 'data':
+            # The shape is a bare pointer instead of a struct.
+            return self.visit(node)
+        else:
+            index = self.const(array_fields[field])
+            ptr = self.builder.gep(self.visit(node), [self.const(0), index])
+            return self.builder.load(ptr)
+
+    def element(self, node):
+        """Pointer to the element of the array addressed by an Index or SetIndex."""
+        ix = self.coerce(self.visit(node.ix), self.typeof(node.ix), int64)
+        dataptr = self.array_field(node.val, 'data')
+        return self.builder.gep(dataptr, [ix])
+
     def visit_Index(self, node):
-        if isinstance(node.val, Var) and node.val.id in self.arrays:
-            val = self.visit(node.val)
-            ix = self.visit(node.ix)
-            dataptr = self.arrays[node.val.id]['data']
-            ret = self.builder.gep(dataptr, [ix])
-            return self.builder.load(ret)
+        return self.builder.load(self.element(node))
+
+    def visit_Broadcast(self, node):
+        if is_array(self.typeof(node.val)):
+            return self.builder.load(self.element(node))
+        return self.visit(node.val)
+
+    def visit_SetIndex(self, node):
+        eltty = self.typeof(node.val).b
+        val = self.coerce(self.visit(node.expr), self.typeof(node.expr), eltty)
+        self.builder.store(val, self.element(node))
+
+    def field(self, node):
+        """Pointer to a field of a record stored in an array, or of an object."""
+        ty = self.typeof(node.val)
+        if is_object(ty):
+            record, ptr = ty.b, self.visit(node.val)
         else:
-            val = self.visit(node.val)
-            ix = self.visit(node.ix)
-            ret = self.builder.gep(val, [ix])
-            return self.builder.load(ret)
+            record, ptr = ty, self.element(node.val)
+        index = record_layout(record)[1][node.name]
+        return self.builder.gep(ptr, [self.const(0), self.const(index)])
+
+    def visit_Field(self, node):
+        if isinstance(node.val, Index) or is_object(self.typeof(node.val)):
+            # Only load the field instead of the whole record.
+            return self.builder.load(self.field(node))
+        index = record_layout(self.typeof(node.val))[1][node.name]
+        return self.builder.extract_value(self.visit(node.val), index)
+
+    def visit_SetField(self, node):
+        ty = self.typeof(node.val)
+        fieldty = (ty.b if is_object(ty) else ty).field(node.name)
+        val = self.coerce(self.visit(node.expr), self.typeof(node.expr), fieldty)
+        self.builder.store(val, self.field(node))
+
+    def allocate(self, lltype, count, zero=False):
+        """Allocates count elements through the runtime allocator.
+        
+        Args:
+            lltype (TYPE): LLVM type of the elements
+            count (TYPE): Number of elements as an i64 value
+            zero (bool): Whether the memory is filled with zeros
+        
+        Returns:
+            TYPE: Pointer to the first element
+        """
+        fnty = Type.function(void_ptr, [int64_type, byte_type])
+        fn = self.module.get_or_insert_function(fnty, allocator_symbol)
+        nbytes = self.builder.mul(count, sizeof(lltype))
+        ptr = self.builder.call(fn, [nbytes, Constant.int(byte_type, int(zero))])
+        return self.builder.bitcast(ptr, pointer(lltype))
+
+    def check_size(self, expected, found):
+        """Returns from the function when an operand doesn't have the expected 
+        number of elements, the runtime records the error and the dispatcher
+        raises it.
+        
+        Args:
+            expected (TYPE): Number of elements as an i64 value
+            found (TYPE): Number of elements of the operand as an i64 value
+        """
+        fail_block = self.add_block('size.mismatch')
+        ok_block = self.add_block('size.ok')
+        self.cbranch(self.builder.icmp(lc.ICMP_NE, expected, found), fail_block, ok_block)
+
+        self.set_block(fail_block)
+        self.fail(size_mismatch_symbol, [expected, found])
+        self.set_block(ok_block)
+
+    def check_nonempty(self, size):
+        """Returns from the function when a reduction without an identity 
+        runs over no elements, like check_size.
+        
+        Args:
+            size (TYPE): Number of elements as an i64 value
+        """
+        fail_block = self.add_block('empty')
+        ok_block = self.add_block('nonempty')
+        zero = Constant.int(int64_type, 0)
+        self.cbranch(self.builder.icmp(lc.ICMP_EQ, size, zero), fail_block, ok_block)
+
+        self.set_block(fail_block)
+        self.fail(empty_reduction_symbol, [])
+        self.set_block(ok_block)
+
+    def fail(self, symbol, args):
+        """Calls the runtime to record an error and returns from the function."""
+        fnty = Type.function(void_type, [arg.type for arg in args])
+        fn = self.module.get_or_insert_function(fnty, symbol)
+        self.builder.call(fn, args)
+        rettype = self.function.type.pointee.return_type
+        if rettype == void_type:
+            self.builder.ret_void()
+        else:
+            self.builder.ret(Constant.undef(rettype))
+
+    def copy_shape(self, src, dst, dims):
+        """Copies a shape array, or only counts the elements when dst is None.
+        
+        Returns:
+            TYPE: Number of elements of an array with that shape as an i64 value
+        """
+        cond_block = self.add_block('shape.cond')
+        body_block = self.add_block('shape.body')
+        end_block = self.add_block('shape.end')
+
+        k = self.alloca(int_type, name='k')
+        count = self.alloca(int64_type, name='count')
+        self.builder.store(self.const(0), k)
+        self.builder.store(Constant.int(int64_type, 1), count)
+        self.branch(cond_block)
+
+        self.set_block(cond_block)
+        cond = self.builder.icmp(lc.ICMP_SLT, self.builder.load(k), dims)
+        self.cbranch(cond, body_block, end_block)
+
+        self.set_block(body_block)
+        kval = self.builder.load(k)
+        size = self.builder.load(self.builder.gep(src, [kval]))
+        if dst is not None:
+            self.builder.store(size, self.builder.gep(dst, [kval]))
+        size = self.builder.sext(size, int64_type)
+        self.builder.store(self.builder.mul(self.builder.load(count), size), count)
+        self.builder.store(self.builder.add(kval, self.const(1)), k)
+        self.branch(cond_block)
+
+        self.set_block(end_block)
+        return self.builder.load(count)
+
+    def visit_Alloc(self, node):
+        ty = self.typeof(node)
+        arrtype = to_lltype(ty).pointee
+        one = Constant.int(int64_type, 1)
+
+        if node.like is not None:
+            dims = self.array_field(node.like, 'dims')
+            shape = self.allocate(int_type, self.builder.sext(dims, int64_type))
+            likeshape = self.array_field(node.like, 'shape')
+            count = self.copy_shape(likeshape, shape, dims)
+        else:
+            dims = self.const(len(node.shape))
+            shape = self.allocate(int_type, Constant.int(int64_type, len(node.shape)))
+            count = one
+            for (k, dim) in enumerate(node.shape):
+                size = self.coerce(self.visit(dim), self.typeof(dim), int32)
+                self.builder.store(size, self.builder.gep(shape, [self.const(k)]))
+                count = self.builder.mul(count, self.builder.sext(size, int64_type))
+
+        data = self.allocate(to_lltype(ty.b), count, node.zero)
+        ndarray = self.allocate(arrtype, one)
+        for (field, val) in [('data', data), ('dims', dims), ('shape', shape)]:
+            index = self.const(array_fields[field])
+            self.builder.store(val, self.builder.gep(ndarray, [self.const(0), index]))
+        return ndarray
+
+    def visit_Tuple(self, node):
+        agg = Constant.undef(self.specialize(node))
+        for (k, elt) in enumerate(node.elts):
+            agg = self.builder.insert_value(agg, self.visit(elt), k)
+        return agg
+
+    def embed(self, name, ty, val):
+        """
+        Emits a captured variable. Numbers become constants LLVM can fold,
+        arrays point to the memory of the NumPy array, which the caller
+        keeps alive as long as the function.
+        """
+        if is_array(ty):
+            view = as_ndarray(val)
+            lltype = to_lltype(ty).pointee
+            zero = self.const(0)
+            address = Constant.int(int64_type, view.ctypes.data)
+            self.arrays[name]['data'] = address.inttoptr(lltype.elements[0])
+            dims, shape = self.constant_shape(name, view.shape)
+            self.arrays[name]['dims'] = dims
+            self.arrays[name]['shape'] = shape
+            struct = self.alloca(lltype, name=name)
+            for (field, index) in array_fields.items():
+                ptr = self.builder.gep(struct, [zero, self.const(index)])
+                self.builder.store(self.arrays[name][field], ptr)
+            self.locals[name] = struct
+        else:
+            self.constants[name] = self.constant(val, ty)
+
+    def constant(self, val, ty):
+        """Constant of a numeric type."""
+        if is_float(ty):
+            return Constant.real(to_lltype(ty), float(val))
+        return Constant.int(to_lltype(ty), int(val))
+
+    def constant_shape(self, name, shape):
+        """
+        Number of dimensions and shape of an array known at compile time,
+        the shape is kept in a global constant of the function.
+        """
+        zero = self.const(0)
+        gv = self.module.add_global_variable(Type.array(int_type, len(shape)),
+                                             '%s.%s_shape' % (self.name, name))
+        gv.initializer = Constant.array(int_type, map(self.const, shape))
+        gv.global_constant = True
+        self.global_vars.append(gv)
+        return self.const(len(shape)), self.builder.gep(gv, [zero, zero])
 
     def visit_Var(self, node):
+        if node.id in self.constants:
+            return self.constants[node.id]
+        if node.id in self.arrays:
+            # Array arguments are already pointers to their struct.
+            return self.locals[node.id]
         return self.builder.load(self.locals[node.id])
 
     def visit_Return(self, node):
         val = self.visit(node.val)
-        if val.type != void_type:
+        val = self.coerce(val, self.typeof(node.val), self.retty)
+        if isinstance(self.retty, TTuple):
+            self.builder.store(val, self.retptr)
+        elif val.type != void_type:
             self.builder.store(val, self.locals['retval'])
         self.builder.branch(self.exit_block)
 
@@ -280,62 +718,224 @@ class LLVMEmitter(object):
         self.branch(init_block)
         self.set_block(init_block)
 
-        start = self.visit(node.begin)
-        stop = self.visit(node.end)
-        step = 1
+        loop = self.loops
+        self.loops += 1
+        self.count(2 * loop)
+
+        varty = self.typeof(node.var)
+        start = self.coerce(self.visit(node.begin), self.typeof(node.begin), varty)
+        stop = self.coerce(self.visit(node.end), self.typeof(node.end), varty)
+        step = Constant.int(to_lltype(varty), 1)
 
         # Setup the increment variable
         varname = node.var.id
-        inc = self.builder.alloca(int_type, name=varname)
+        inc = self.alloca(to_lltype(varty), name=varname)
         self.builder.store(start, inc)
         self.locals[varname] = inc
 
         # Setup the loop condition
         self.branch(test_block)
         self.set_block(test_block)
-        cond = self.builder.icmp(lc.ICMP_SLT, self.builder.load(inc), stop)
+        cond = self.compare('lt', self.builder.load(inc), stop, varty)
         self.builder.cbranch(cond, body_block, end_block)
 
         # Generate the loop body
         self.set_block(body_block)
+        self.count(2 * loop + 1)
         map(self.visit, node.body)
 
         # Increment the counter
-        succ = self.builder.add(self.const(step), self.builder.load(inc))
+        succ = self.builder.add(step, self.builder.load(inc))
         self.builder.store(succ, inc)
 
         # Exit the loop
         self.builder.branch(test_block)
         self.set_block(end_block)
 
+    def count(self, k):
+        """Increments a profile counter, they are not atomic."""
+        if self.counters is None:
+            return
+        address = Constant.int(int64_type, self.counters.ctypes.data + 8 * k)
+        ptr = address.inttoptr(pointer(int64_type))
+        self.builder.store(self.builder.add(self.builder.load(ptr), Constant.int(int64_type, 1)), ptr)
+
     def visit_Prim(self, node):
         if node.fn == "shape#":
-            ref = node.args[0]
-            shape = self.arrays[ref.id]['shape']
-            return shape
+            return self.array_field(node.args[0], 'shape')
+        elif node.fn == "size#":
+            # Number of elements of the first array operand, the others
+            # must have as many.
+            arrays = [arg for arg in node.args if is_array(self.typeof(arg))]
+            if not arrays:
+                raise TypeError("Whole array expression without any array")
+            sizes = [self.copy_shape(self.array_field(arr, 'shape'), None,
+                                     self.array_field(arr, 'dims'))
+                     for arr in arrays]
+            for size in sizes[1:]:
+                self.check_size(sizes[0], size)
+            return sizes[0]
+        elif node.fn in ("min#", "max#"):
+            a, b = self.visit_operands(node)
+            return self.select(node.fn, a, b, self.typeof(node))
         elif node.fn == "mult#":
-            a = self.visit(node.args[0])
-            b = self.visit(node.args[1])
-            if a.type == double_type:
+            a, b = self.visit_operands(node)
+            if is_float(self.typeof(node)):
                 return self.builder.fmul(a, b)
             else:
                 return self.builder.mul(a, b)
         elif node.fn == "add#":
-            a = self.visit(node.args[0])
-            b = self.visit(node.args[1])
-            if a.type == double_type:
+            a, b = self.visit_operands(node)
+            if is_float(self.typeof(node)):
                 return self.builder.fadd(a, b)
             else:
                 return self.builder.add(a, b)
         else:
             raise NotImplementedError
 
+    def compare(self, op, a, b, ty):
+        """Compares two values of a numeric type, op is 'lt', 'gt' or 'eq'."""
+        if is_float(ty):
+            pred = {'lt': lc.FCMP_OLT, 'gt': lc.FCMP_OGT, 'eq': lc.FCMP_OEQ}[op]
+            return self.builder.fcmp(pred, a, b)
+        elif is_unsigned(ty):
+            pred = {'lt': lc.ICMP_ULT, 'gt': lc.ICMP_UGT, 'eq': lc.ICMP_EQ}[op]
+        else:
+            pred = {'lt': lc.ICMP_SLT, 'gt': lc.ICMP_SGT, 'eq': lc.ICMP_EQ}[op]
+        return self.builder.icmp(pred, a, b)
+
+    def select(self, fn, a, b, ty):
+        """Minimum or maximum of two values, the first one on ties."""
+        op = 'lt' if fn in ("min#", "argmin#") else 'gt'
+        return self.builder.select(self.compare(op, b, a, ty), b, a)
+
+    def isnan(self, a, ty):
+        """Whether a value is NaN, always false for integers."""
+        if is_float(ty):
+            return self.builder.fcmp(lc.FCMP_UNO, a, a)
+        return Constant.int(bool_type, 0)
+
+    def improves(self, fn, val, cur, ty):
+        """Whether a reduction replaces its current value with val. Like 
+        NumPy the first NaN wins and is kept."""
+        op = 'lt' if fn in ("min#", "argmin#") else 'gt'
+        better = self.compare(op, val, cur, ty)
+        if not is_float(ty):
+            return better
+        first_nan = self.builder.and_(self.isnan(val, ty),
+                                      self.builder.not_(self.isnan(cur, ty)))
+        return self.builder.or_(better, first_nan)
+
+    def identity(self, fn, ty):
+        """Initial value of the accumulators of a reduction, which is also
+        the result of sums and means of empty arrays."""
+        lltype = to_lltype(ty)
+        lower = fn in ("min#", "argmin#")
+        if fn in ("add#", "mean#"):
+            return Constant.real(lltype, 0) if is_float(ty) else Constant.int(lltype, 0)
+        elif is_float(ty):
+            return Constant.real(lltype, float('inf') if lower else float('-inf'))
+        elif is_unsigned(ty):
+            return Constant.int(lltype, 2**lltype.width - 1 if lower else 0)
+        bound = 2**(lltype.width - 1)
+        return Constant.int_signextend(lltype, bound - 1 if lower else -bound)
+
+    def visit_Reduce(self, node):
+        """
+        Reduction of a whole array expression. The loop is unrolled over 
+        several independent accumulators, which breaks the dependency 
+        chain LLVM can't reassociate for floating point sums and leaves 
+        it free to vectorize. A second loop reduces the remaining elements.
+        Computing the size checks the operands have the same number of
+        elements, min, max, argmin and argmax also check there is one. 
+        NaNs propagate as in NumPy.
+        """
+        eltty = self.typeof(node.elt)
+        tracks_index = node.fn in ("argmin#", "argmax#")
+        accty = eltty if tracks_index else self.typeof(node)
+        size = self.visit(node.size)
+        if node.fn in no_identity:
+            self.check_nonempty(size)
+        ix = self.alloca(int64_type, name=node.ix.id)
+        self.locals[node.ix.id] = ix
+
+        accs = [self.alloca(to_lltype(accty), name='acc') for k in range(accumulators)]
+        indices = [self.alloca(int64_type, name='argacc') for k in range(accumulators)]
+        for (acc, index) in zip(accs, indices):
+            self.builder.store(self.identity(node.fn, accty), acc)
+            self.builder.store(Constant.int(int64_type, 0), index)
+
+        def accumulate(k, pos):
+            self.builder.store(pos, ix)
+            val = self.coerce(self.visit(node.elt), eltty, accty)
+            cur = self.builder.load(accs[k])
+            if node.fn in ("add#", "mean#"):
+                add = self.builder.fadd if is_float(accty) else self.builder.add
+                self.builder.store(add(cur, val), accs[k])
+            else:
+                better = self.improves(node.fn, val, cur, accty)
+                self.builder.store(self.builder.select(better, val, cur), accs[k])
+                if tracks_index:
+                    index = self.builder.load(indices[k])
+                    self.builder.store(self.builder.select(better, pos, index), indices[k])
+
+        counter = self.alloca(int64_type, name='i')
+        self.builder.store(Constant.int(int64_type, 0), counter)
+        for (step, name) in [(accumulators, 'unrolled'), (1, 'rest')]:
+            cond_block = self.add_block(name + '.cond')
+            body_block = self.add_block(name + '.body')
+            end_block = self.add_block(name + '.end')
+            self.branch(cond_block)
+
+            self.set_block(cond_block)
+            i = self.builder.load(counter)
+            last = self.builder.add(i, Constant.int(int64_type, step - 1))
+            self.cbranch(self.builder.icmp(lc.ICMP_SLT, last, size), body_block, end_block)
+
+            self.set_block(body_block)
+            for k in range(step):
+                accumulate(k, self.builder.add(i, Constant.int(int64_type, k)))
+            self.builder.store(self.builder.add(i, Constant.int(int64_type, step)), counter)
+            self.branch(cond_block)
+            self.set_block(end_block)
+
+        # Combine the accumulators, on ties, NaNs included, the lowest index wins.
+        result = self.builder.load(accs[0])
+        best = self.builder.load(indices[0])
+        for (acc, index) in zip(accs[1:], indices[1:]):
+            val = self.builder.load(acc)
+            if node.fn in ("add#", "mean#"):
+                add = self.builder.fadd if is_float(accty) else self.builder.add
+                result = add(result, val)
+            else:
+                index = self.builder.load(index)
+                same = self.builder.or_(self.compare('eq', val, result, accty),
+                                        self.builder.and_(self.isnan(val, accty),
+                                                          self.isnan(result, accty)))
+                tie = self.builder.and_(same, self.builder.icmp(lc.ICMP_SLT, index, best))
+                better = self.builder.or_(self.improves(node.fn, val, result, accty), tie)
+                result = self.builder.select(better, val, result)
+                best = self.builder.select(better, index, best)
+
+        if tracks_index:
+            return best
+        elif node.fn == "mean#":
+            return self.builder.fdiv(result, self.coerce(size, int64, accty))
+        return result
+
+    def visit_operands(self, node):
+        """Emits the operands of a primitive promoted to the type of its result."""
+        ty = self.typeof(node)
+        return [self.coerce(self.visit(arg), self.typeof(arg), ty)
+                for arg in node.args]
+
     def visit_Assign(self, node):
         # Subsequent assignment
         if node.ref in self.locals:
             name = node.ref
             var = self.locals[name]
             val = self.visit(node.val)
+            val = self.coerce(val, self.typeof(node.val), self.typeof(node))
             self.builder.store(val, var)
             self.locals[name] = var
             return var
@@ -344,8 +944,9 @@ class LLVMEmitter(object):
         else:
             name = node.ref
             val = self.visit(node.val)
+            val = self.coerce(val, self.typeof(node.val), self.typeof(node))
             ty = self.specialize(node)
-            var = self.builder.alloca(ty, name=name)
+            var = self.alloca(ty, name=name)
             self.builder.store(val, var)
             self.locals[name] = var
             return var
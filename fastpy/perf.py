@@ -0,0 +1,53 @@
+"""
+Linux perf support.
+
+perf can't see the symbols of JIT'd code, it looks them up in the map file
+/tmp/perf-<pid>.map instead, one "START SIZE name" line per function with
+the addresses in hexadecimal.
+
+The JIT doesn't tell the size of the machine code of a function, we take
+it from the ELF symbol table of the function compiled alone to an object
+file, which is generated the same way.
+"""
+import os
+import struct
+import threading
+
+_lock = threading.Lock()
+
+SHT_SYMTAB = 2
+
+def map_path():
+    return '/tmp/perf-%d.map' % os.getpid()
+
+def write_entry(address, size, name):
+    with _lock:
+        with open(map_path(), 'a') as f:
+            f.write('%x %x %s\n' % (address, size, name))
+
+def symbol_sizes(obj):
+    """Sizes of the symbols of a 64 bits little endian ELF object.
+
+    Args:
+        obj (str): Content of the object file
+
+    Returns:
+        dict: Size in bytes indexed by symbol name, empty for other formats
+    """
+    if obj[:4] != '\x7fELF' or obj[4] != '\x02' or obj[5] != '\x01':
+        return {}
+    shoff, = struct.unpack_from('<Q', obj, 0x28)
+    shentsize, shnum = struct.unpack_from('<HH', obj, 0x3A)
+    sections = [struct.unpack_from('<IIQQQQIIQQ', obj, shoff + k * shentsize)
+                for k in range(shnum)]
+
+    sizes = {}
+    for (_, shtype, _, _, offset, size, link, _, _, entsize) in sections:
+        if shtype != SHT_SYMTAB:
+            continue
+        strtab = sections[link][4]
+        for k in range(size // entsize):
+            name, _, _, _, _, symsize = struct.unpack_from('<IBBHQQ', obj, offset + k * entsize)
+            end = obj.index('\0', strtab + name)
+            sizes[obj[strtab + name:end]] = symsize
+    return sizes
@@ -1,9 +1,14 @@
 import pprint
 import ast
 
+from core_language import Node, iter_fields
+
 def ast2tree(node, include_attrs=True):
     def _transform(node):
-        if isinstance(node, ast.AST):
+        if isinstance(node, Node):
+            return (node.__class__.__name__,
+                    dict((a, _transform(b)) for a, b in iter_fields(node)))
+        elif isinstance(node, ast.AST):
             fields = ((a, _transform(b))
                       for a, b in ast.iter_fields(node))
             if include_attrs:
@@ -12,12 +17,12 @@ def ast2tree(node, include_attrs=True):
                          if hasattr(node, a))
                 return (node.__class__.__name__, dict(fields), dict(attrs))
             return (node.__class__.__name__, dict(fields))
-        elif isinstance(node, list):
+        elif isinstance(node, (list, tuple)):
             return [_transform(x) for x in node]
         elif isinstance(node, str):
             return repr(node)
         return node
-    if not isinstance(node, ast.AST):
+    if not isinstance(node, (ast.AST, Node)):
         raise TypeError('expected AST, got %r' % node.__class__.__name__)
     return _transform(node)
 
@@ -0,0 +1,70 @@
+"""
+Codegen quality report of a compiled specialization.
+
+llvmpy doesn't expose the remarks of the LLVM passes, so the report is read
+from the IR of the function: a loop is found from a branch back to an
+earlier block, and it was vectorized when its body computes on vectors,
+the widest one gives the width chosen. The emitter and the passes name
+every block, which is how branches are matched to them.
+"""
+import llvm.core as lc
+
+def counts(function):
+    """Number of instructions and basic blocks of a function."""
+    blocks = function.basic_blocks
+    return dict(instructions=sum(len(bb.instructions) for bb in blocks),
+                blocks=len(blocks))
+
+def vector_width(inst):
+    """Lanes of the widest vector an instruction reads or computes, 1 for scalars."""
+    types = [inst.type] + [op.type for op in inst.operands]
+    return max([ty.count for ty in types if ty.kind == lc.TYPE_VECTOR] or [1])
+
+def loops(function):
+    """
+    Loops of a function, in the order of their headers. The blocks of an
+    inner loop are part of the outer loop too.
+
+    Returns:
+        list: The header and the blocks of every loop
+    """
+    blocks = function.basic_blocks
+    positions = dict((bb.name, k) for (k, bb) in enumerate(blocks) if bb.name)
+    latches = {}
+    for (k, bb) in enumerate(blocks):
+        for op in bb.instructions[-1].operands:
+            header = positions.get(op.name) if op.name else None
+            if header is not None and header <= k:
+                latches[header] = max(latches.get(header, k), k)
+    return [(blocks[first], blocks[first:latch + 1])
+            for (first, latch) in sorted(latches.items())]
+
+def report(function, before):
+    """
+    Quality report of an optimized function.
+
+    Args:
+        function (llvm.core.Function): Function after optimization
+        before (dict): Its counts() before optimization
+
+    Returns:
+        dict: Counts before and after optimization, with the allocas left,
+              the loops, with their vector width and the loads and stores
+              in their body, and the calls which weren't inlined
+    """
+    insts = [inst for bb in function.basic_blocks for inst in bb.instructions]
+    after = counts(function)
+    after['allocas'] = sum(inst.opcode_name == 'alloca' for inst in insts)
+
+    found = []
+    for (header, body) in loops(function):
+        body = [inst for bb in body for inst in bb.instructions]
+        width = max(map(vector_width, body))
+        found.append(dict(header=header.name, instructions=len(body),
+                          vectorized=width > 1, width=width,
+                          loads=sum(inst.opcode_name == 'load' for inst in body),
+                          stores=sum(inst.opcode_name == 'store' for inst in body)))
+
+    callees = [inst.called_function.name for inst in insts if inst.opcode_name == 'call']
+    calls = sorted(set(name for name in callees if not name.startswith('llvm.')))
+    return dict(before=before, after=after, loops=found, calls=calls)
@@ -0,0 +1,177 @@
+"""
+Runtime support called from the JIT'd code.
+
+Arrays created inside a compiled function are allocated by NumPy itself
+through a ctypes callback, so they can be handed back to Python as regular
+ndarrays which own (and eventually free) their memory.
+
+Every buffer allocated during a call is kept alive in an arena until the
+dispatcher has picked the ones returned to the caller, the rest of them
+are released when the call ends.
+
+Errors detected by the compiled code, like operands of an array expression
+with different sizes, are recorded by a callback before the function
+returns, and raised by the dispatcher once it has returned.
+"""
+import ctypes
+import threading
+from collections import deque
+from contextlib import contextmanager
+from timeit import default_timer
+
+import numpy as np
+
+_local = threading.local()
+
+def allocate(nbytes, zero):
+    if zero:
+        buf = np.zeros(max(nbytes, 1), dtype=np.uint8)
+    else:
+        buf = np.empty(max(nbytes, 1), dtype=np.uint8)
+    address = buf.ctypes.data
+    _local.buffers[address] = buf
+    return address
+
+@contextmanager
+def arena():
+    """Collects the buffers allocated by the compiled code on this thread.
+
+    Yields:
+        dict: Buffers indexed by their address
+    """
+    previous = getattr(_local, 'buffers', None)
+    _local.buffers = {}
+    try:
+        yield _local.buffers
+    finally:
+        _local.buffers = previous
+
+allocator_symbol = 'fastpy_allocate'
+allocator_type = ctypes.CFUNCTYPE(ctypes.c_void_p, ctypes.c_int64, ctypes.c_int8)
+allocator = allocator_type(allocate)
+allocator_address = ctypes.cast(allocator, ctypes.c_void_p).value
+
+def size_mismatch(expected, found):
+    _local.error = ValueError("operands could not be broadcast together with sizes %d and %d"
+                              % (expected, found))
+
+def empty_reduction():
+    _local.error = ValueError("zero-size array to reduction operation which has no identity")
+
+def raise_error():
+    """Raises the error recorded by the last call on this thread, if any."""
+    error = getattr(_local, 'error', None)
+    if error is not None:
+        _local.error = None
+        raise error
+
+size_mismatch_symbol = 'fastpy_size_mismatch'
+size_mismatch_type = ctypes.CFUNCTYPE(None, ctypes.c_int64, ctypes.c_int64)
+size_mismatch_callback = size_mismatch_type(size_mismatch)
+size_mismatch_address = ctypes.cast(size_mismatch_callback, ctypes.c_void_p).value
+
+empty_reduction_symbol = 'fastpy_empty_reduction'
+empty_reduction_type = ctypes.CFUNCTYPE(None)
+empty_reduction_callback = empty_reduction_type(empty_reduction)
+empty_reduction_address = ctypes.cast(empty_reduction_callback, ctypes.c_void_p).value
+
+class CallStats(object):
+    """
+    Call statistics of a specialization, collected when the function is
+    decorated with stats=True. Dispatch overhead is the difference between
+    the time of the calls and the time spent in native code.
+    
+    Attributes:
+        calls (int): Number of calls
+        max_native_time (float): Longest time in native code, in seconds
+        native_time (float): Time spent in native code, in seconds
+        nbytes (int): Bytes of array data passed
+        time (float): Time of the calls, dispatch included, in seconds
+    """
+    __slots__ = ['calls', 'time', 'native_time', 'max_native_time', 'nbytes']
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.calls = 0
+        self.time = 0.0
+        self.native_time = 0.0
+        self.max_native_time = 0.0
+        self.nbytes = 0
+
+    def timed(self, fn):
+        """Wraps the native function to measure the time spent in it."""
+        def _timed(*args):
+            start = default_timer()
+            try:
+                return fn(*args)
+            finally:
+                elapsed = default_timer() - start
+                self.native_time += elapsed
+                self.max_native_time = max(self.max_native_time, elapsed)
+        return _timed
+
+    def record(self, elapsed, nbytes):
+        self.calls += 1
+        self.time += elapsed
+        self.nbytes += nbytes
+
+    def merge(self, other):
+        self.calls += other.calls
+        self.time += other.time
+        self.native_time += other.native_time
+        self.max_native_time = max(self.max_native_time, other.max_native_time)
+        self.nbytes += other.nbytes
+
+    def as_dict(self):
+        return dict(calls=self.calls, time=self.time, native_time=self.native_time,
+                    dispatch_time=self.time - self.native_time,
+                    max_native_time=self.max_native_time, nbytes=self.nbytes)
+
+class MachineCode(object):
+    """
+    Compiled function of a specialization and the calls in flight on it, 
+    its machine code is only freed once they have returned. Appending to 
+    and popping from a deque are atomic, which keeps the count exact 
+    without taking a lock on every call. A call reaching code retired in
+    the meantime isn't run on it but dispatched again: retired is set 
+    before the calls are counted, and read after a call is counted.
+
+    Attributes:
+        calls (deque): One item per call in flight
+        global_vars (list): Global variables of the module only the function
+                            uses, like the shapes of captured arrays
+        llfunc (llvm.core.Function): Compiled function
+        referenced (tuple): Objects the code points to, like captured arrays
+                            and profile counters, kept alive as long as it
+        retired (bool): Whether the code was replaced or evicted
+    """
+    __slots__ = ['llfunc', 'referenced', 'global_vars', 'calls', 'retired']
+
+    def __init__(self, llfunc, referenced=(), global_vars=()):
+        self.llfunc = llfunc
+        self.referenced = referenced
+        self.global_vars = global_vars
+        self.calls = deque()
+        self.retired = False
+
+    def guard(self, fn, redispatch):
+        """
+        Wraps the native function to count the calls in flight.
+
+        Args:
+            fn (function): Wrapped native function
+            redispatch (function): Called with the arguments instead of fn
+                                   once the code is retired
+        """
+        calls = self.calls
+        def _guarded(*args):
+            calls.append(None)
+            try:
+                if self.retired:
+                    return redispatch(*args)
+                return fn(*args)
+            finally:
+                calls.pop()
+        return _guarded
@@ -1,6 +1,7 @@
 import string
 
-from type_system import TVar, TFun, int32, int64, double64
+from core_language import Assign, Loop, walk
+from type_system import TVar, TFun, TTuple, TField, TElement, TArithmetic, int32, int64, double64, array
 
 class TypeInfer(object):
     """
@@ -85,13 +86,28 @@ class TypeInfer(object):
         $b ~ $a
         $b ~ $retty
 
+    Arithmetic, assignments and returns don't force both sides to have the
+    same type. Instead they generate promotion constraints (ty, tv), read as
+    "ty must be promoted to tv", which are solved once the argument types
+    are known by ConstrainSolver.promote using the numeric lattice
+    Int32 < Int64 < Float < Double. Every variable gets its own type
+    variable which is the widest type ever assigned to it.
 
+    Names which are neither arguments nor assigned in the function are
+    globals or closure variables. They get a type variable too, listed in
+    captured, and their values are read when the function is specialized.
 
+    The types of the nodes are kept in the types side table, the nodes are
+    immutable.
     """
 
     def __init__(self):
         self.constraints = []
+        self.promotions = []
         self.env = {}
+        self.locals = set()
+        self.captured = []
+        self.types = {}
         self.names = self.naming()
 
     def naming(self):
@@ -121,8 +137,11 @@ class TypeInfer(object):
         self.argtys = [self.fresh() for v in node.args]
         self.retty = TVar("$retty")
         for (arg, ty) in zip(node.args, self.argtys):
-            arg.type = ty
-            self.env[arg.id] = ty
+            # The local copy of an argument can be widened by later assignments.
+            self.types[arg] = self.env[arg.id] = self.fresh()
+            self.promotions += [(ty, self.types[arg])]
+        self.locals = set(n.ref for n in walk(node) if isinstance(n, Assign))
+        self.locals |= set(n.var.id for n in walk(node) if isinstance(n, Loop))
         map(self.visit, node.body)
         return TFun(self.argtys, self.retty)
 
@@ -130,67 +149,144 @@ class TypeInfer(object):
         return None
 
     def visit_LitInt(self, node):
-        #TODO choose correct integer size. and handle constrain between
-        #different integer types
         tv = int64
-        node.type = tv
+        self.types[node] = tv
         return tv
 
     def visit_LitFloat(self, node):
-        #TODO choose correct float size. and handle constrain between
-        #different float types
         tv = double64
-        node.type = tv
+        self.types[node] = tv
         return tv
 
     def visit_Assign(self, node):
         ty = self.visit(node.val)
-        if node.ref in self.env:
-            # Subsequent uses of a variable must have the same type.
-            self.constraints += [(ty, self.env[node.ref])]
-        self.env[node.ref] = ty
-        node.type = ty
+        if node.ref not in self.env:
+            self.env[node.ref] = self.fresh()
+        # The variable holds the promotion of every value assigned to it.
+        self.promotions += [(ty, self.env[node.ref])]
+        self.types[node] = self.env[node.ref]
         return None
 
     def visit_Index(self, node):
         tv = self.fresh()
         ty = self.visit(node.val)
-        ixty = self.visit(node.ix)
-        self.constraints += [(ty, array(tv)), (ixty, int32)]
+        self.visit(node.ix)
+        self.constraints += [(ty, array(tv))]
+        self.types[node] = tv
         return tv
 
+    def visit_SetIndex(self, node):
+        tv = self.fresh()
+        ty = self.visit(node.val)
+        self.visit(node.ix)
+        # The stored value is converted to the element type of the array.
+        self.visit(node.expr)
+        self.constraints += [(ty, array(tv))]
+        return None
+
+    def visit_Broadcast(self, node):
+        # Arrays or scalars, which is only known with the argument types.
+        tv = self.fresh()
+        ty = self.visit(node.val)
+        self.visit(node.ix)
+        self.promotions += [(TElement(ty), tv)]
+        self.types[node] = tv
+        return tv
+
+    def visit_Reduce(self, node):
+        self.visit(node.size)
+        self.env[node.ix.id] = int64
+        ty = self.visit(node.elt)
+        if node.fn in ("argmin#", "argmax#"):
+            self.types[node] = int64
+            return self.types[node]
+        tv = self.fresh()
+        self.promotions += [(ty, tv)]
+        if node.fn == "add#":
+            # Like NumPy, integers are summed in 64 bits.
+            self.promotions += [(int64, tv)]
+        elif node.fn == "mean#":
+            self.promotions += [(double64, tv)]
+        self.types[node] = tv
+        return tv
+
+    def visit_Field(self, node):
+        # The fields are only known once the record type is, so the
+        # field type is resolved along with the promotions.
+        tv = self.fresh()
+        ty = self.visit(node.val)
+        self.promotions += [(TField(ty, node.name), tv)]
+        self.types[node] = tv
+        return tv
+
+    def visit_SetField(self, node):
+        self.visit(node.val)
+        # The stored value is converted to the type of the field.
+        self.visit(node.expr)
+        return None
+
+    def visit_Alloc(self, node):
+        if node.like is not None:
+            tv = self.fresh()
+            ty = self.visit(node.like)
+            self.constraints += [(ty, array(tv))]
+            self.types[node] = array(node.elt or tv)
+        else:
+            map(self.visit, node.shape)
+            self.types[node] = array(node.elt)
+        return self.types[node]
+
     def visit_Prim(self, node):
         if node.fn == "shape#":
-            return array(int32)
-        elif node.fn == "mult#":
+            self.visit(node.args[0])
+            self.types[node] = array(int32)
+            return self.types[node]
+        elif node.fn == "size#":
+            map(self.visit, node.args)
+            self.types[node] = int64
+            return self.types[node]
+        elif node.fn in ("min#", "max#"):
+            tv = self.fresh()
             tya = self.visit(node.args[0])
             tyb = self.visit(node.args[1])
-            self.constraints += [(tya, tyb)]
-            return tyb
-        elif node.fn == "add#":
+            self.promotions += [(tya, tv), (tyb, tv)]
+            self.types[node] = tv
+            return tv
+        elif node.fn in ("mult#", "add#"):
+            # The operands are promoted to tv, booleans are counted.
+            tv = self.fresh()
+            tyr = self.fresh()
             tya = self.visit(node.args[0])
             tyb = self.visit(node.args[1])
-            self.constraints += [(tya, tyb)]
-            return tyb
+            self.promotions += [(tya, tv), (tyb, tv), (TArithmetic(tv), tyr)]
+            self.types[node] = tyr
+            return tyr
         else:
             raise NotImplementedError
 
+    def visit_Tuple(self, node):
+        self.types[node] = TTuple(map(self.visit, node.elts))
+        return self.types[node]
+
     def visit_Var(self, node):
+        if node.id not in self.env and node.id not in self.locals:
+            self.env[node.id] = self.fresh()
+            self.captured.append((node.id, self.env[node.id]))
         ty = self.env[node.id]
-        node.type = ty
+        self.types[node] = ty
         return ty
 
     def visit_Return(self, node):
         ty = self.visit(node.val)
-        self.constraints += [(ty, self.retty)]
+        self.promotions += [(ty, self.retty)]
 
     def visit_Loop(self, node):
-        self.env[node.var.id] = int32
+        if node.var.id not in self.env:
+            self.env[node.var.id] = self.fresh()
         varty = self.visit(node.var)
         begin = self.visit(node.begin)
         end = self.visit(node.end)
-        self.constraints += [(varty, int32), (
-            begin, int64), (end, int32)]
+        self.promotions += [(begin, varty), (end, varty)]
         map(self.visit, node.body)
 
     def generic_visit(self, node):
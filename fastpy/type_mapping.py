@@ -1,29 +1,53 @@
+import array
 import ctypes
 
 import llvm.core as lc
 import numpy as np
 
+from type_system import TTuple, is_array, numpy_names, boolean, uint8, uint16
+from runtime import arena, raise_error
+
 # Adapt the LLVM types to use libffi/ctypes wrapper so we can dynamically create
 # the appropriate C types for our JIT'd function at runtime.
+# LLVM integers are signless so unsigned dtypes share the signed C type.
 _nptypemap = {
+    '?': ctypes.c_int8,
+    'b': ctypes.c_int8,
+    'B': ctypes.c_int8,
+    'h': ctypes.c_int16,
+    'H': ctypes.c_int16,
     'i': ctypes.c_int,
+    'l': ctypes.c_int64,
+    'q': ctypes.c_int64,
     'f': ctypes.c_float,
     'd': ctypes.c_double,
 }
 
+# Results whose C type isn't told by the signless LLVM type.
+_result_ctypes = {
+    boolean: ctypes.c_bool,
+    uint8: ctypes.c_uint8,
+    uint16: ctypes.c_uint16,
+}
+
 def mangler(fname, sig):
     return fname + str(hash(tuple(sig)))
 
-def wrap_module(sig, llfunc, engine):
-    pfunc = wrap_function(llfunc, engine)
-    dispatch = dispatcher(pfunc)
+def wrap_module(sig, llfunc, engine, retty=None, allocates=False, stats=None, checked=False):
+    pfunc = wrap_function(llfunc, engine, retty)
+    dispatch = dispatcher(pfunc, retty, allocates, stats, checked)
     return dispatch
 
-def wrap_function(func, engine):
+def wrap_function(func, engine, retty=None):
     args = func.type.pointee.args
     ret_type = func.type.pointee.return_type
-    ret_ctype = wrap_type(ret_type)
     args_ctypes = map(wrap_type, args)
+    if isinstance(retty, TTuple):
+        # Tuples are written into a struct passed as the first argument.
+        ret_ctype = None
+        args_ctypes[0] = ctypes.POINTER(result_ctype(retty, args[0].pointee))
+    else:
+        ret_ctype = result_ctype(retty, ret_type)
 
     functype = ctypes.CFUNCTYPE(ret_ctype, *args_ctypes)
     fptr = engine.get_pointer_to_function(func)
@@ -45,18 +69,12 @@ def wrap_type(llvm_type):
     elif kind == lc.TYPE_POINTER:
         pointee = llvm_type.pointee
         p_kind = pointee.kind
-        if p_kind == lc.TYPE_INTEGER:
-            width = pointee.width
-            if width == 8:
-                ctype = ctypes.c_char_p
-            else:
-                ctype = ctypes.POINTER(wrap_type(pointee))
-        elif p_kind == lc.TYPE_VOID:
+        if p_kind == lc.TYPE_VOID:
             ctype = ctypes.c_void_p
         else:
             ctype = ctypes.POINTER(wrap_type(pointee))
     elif kind == lc.TYPE_STRUCT:
-        struct_name = llvm_type.name.split('.')[-1]
+        struct_name = llvm_type.name.split('.')[-1] or 'tuple'
         struct_name = struct_name.encode('ascii')
         struct_type = None
 
@@ -68,38 +86,149 @@ def wrap_type(llvm_type):
         else:
             names = ["field"+str(n) for n in range(llvm_type.element_count)]
 
-        ctype = type(ctypes.Structure)(struct_name, (ctypes.Structure,),
-                                       {'__module__': "numpile"})
+        attrs = {'__module__': "numpile"}
+        if llvm_type.packed:
+            # Records keep the layout of their NumPy dtype.
+            attrs['_pack_'] = 1
+        ctype = type(ctypes.Structure)(struct_name, (ctypes.Structure,), attrs)
 
         fields = [(name, wrap_type(elem))
                   for name, elem in zip(names, llvm_type.elements)]
         setattr(ctype, '_fields_', fields)
+    elif kind == lc.TYPE_ARRAY:
+        ctype = wrap_type(llvm_type.element) * llvm_type.count
     else:
         raise Exception("Unknown LLVM type %s" % kind)
     return ctype
 
-def wrap_ndarray(na):
+def result_ctype(ty, llvm_type):
+    """C type of a result of the fastpy type ty, unsigned and boolean 
+    values are read as such rather than as signed integers of their width."""
+    if ty in _result_ctypes:
+        return _result_ctypes[ty]
+    elif isinstance(ty, TTuple):
+        fields = [("field" + str(n), result_ctype(eltty, elem))
+                  for (n, (eltty, elem)) in enumerate(zip(ty.types, llvm_type.elements))]
+        return type(ctypes.Structure)('tuple', (ctypes.Structure,),
+                                      {'__module__': "numpile", '_fields_': fields})
+    return wrap_type(llvm_type)
+
+def as_ndarray(obj):
+    """Zero copy ndarray view of an object exposing the buffer protocol 
+    (memmaps, array.array, bytearray, memoryview...).
+
+    Returns:
+        TYPE: The view, or None if the object doesn't expose a buffer.
+    """
+    if isinstance(obj, np.ndarray):
+        return obj
+    elif isinstance(obj, (np.generic, basestring)):
+        # Strings expose their bytes, but they are text, not arrays.
+        return None
+    elif isinstance(obj, array.array):
+        # Python 2 arrays only have the old buffer protocol.
+        return np.frombuffer(obj, dtype=obj.typecode)
+    try:
+        # The format of the items and the strides of the buffer are kept.
+        return np.asarray(obj if isinstance(obj, memoryview) else memoryview(obj))
+    except (TypeError, ValueError):
+        pass
+    try:
+        # The old buffer protocol has no item format, only bytes.
+        return np.frombuffer(obj, dtype=np.uint8)
+    except (TypeError, ValueError, AttributeError):
+        return None
+
+def wrap_ndarray(na, ptrtype=None):
     # For NumPy arrays grab the underlying data pointer. Doesn't copy.
-    ctype = _nptypemap[na.dtype.char]
+    if ptrtype is None:
+        ptrtype = ctypes.POINTER(_nptypemap[na.dtype.char])
     _shape = list(na.shape)
-    data = na.ctypes.data_as(ctypes.POINTER(ctype))
+    # The compiled code holds dimensions in 32 bits.
+    if any(size >= 2**31 for size in _shape):
+        raise ValueError("Arrays with 2**31 or more elements along a dimension aren't supported")
+    data = na.ctypes.data_as(ptrtype)
     dims = len(na.strides)
     shape = (ctypes.c_int*dims)(*_shape)
     return (data, dims, shape)
 
 def wrap_arg(arg, val):
-    if isinstance(val, np.ndarray):
+    if isinstance(val, (int, long, float)):
+        return val
+    elif isinstance(val, np.generic):
+        # NumPy scalars have the layout of the C type, copy their bytes.
+        return arg.from_buffer_copy(val)
+    elif hasattr(val, '_fastpy_type_'):
+        # Objects of a jitclass are passed by pointer to their struct.
+        return ctypes.cast(val._data.ctypes.data, arg)
+    view = as_ndarray(val)
+    if view is not None:
+        # The compiled code indexes the data as a C contiguous array.
+        if not view.flags.c_contiguous:
+            raise ValueError("Arrays must be contiguous, copy it with np.ascontiguousarray")
         ndarray = arg._type_
-        data, dims, shape = wrap_ndarray(val)
+        # The data pointer type also covers records, which have no typecode.
+        data, dims, shape = wrap_ndarray(view, ndarray._fields_[0][1])
         return ndarray(data, dims, shape)
     else:
         return val
 
-def dispatcher(fn):
+def unwrap_ndarray(ptr, ty, buffers, args):
+    # Arrays allocated by the compiled code become views of the NumPy 
+    # buffer backing them, so NumPy owns and frees the memory.
+    nd = ptr.contents
+    address = ctypes.cast(nd.field0, ctypes.c_void_p).value
+    shape = tuple(nd.field2[k] for k in range(nd.field1))
+    if address in buffers:
+        dtype = np.dtype(numpy_names[ty.b])
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        return buffers[address][:nbytes].view(dtype).reshape(shape)
+    for arg in args:
+        if isinstance(arg, np.ndarray) and arg.ctypes.data == address:
+            return arg
+    raise Exception("Returned array is not owned by any NumPy array")
+
+def unwrap_tuple(out, ty, buffers, args):
+    vals = [getattr(out, name) for (name, _) in out._fields_]
+    return tuple(unwrap_ndarray(val, eltty, buffers, args) if is_array(eltty) else val
+                 for (val, eltty) in zip(vals, ty.types))
+
+def dispatcher(fn, retty=None, allocates=False, stats=None, checked=False):
+    call = fn if stats is None else stats.timed(fn)
     def _call_closure(*args):
         cargs = list(fn._argtypes_)
         pargs = list(args)
         rargs = map(wrap_arg, cargs, pargs)
-        return fn(*rargs)
+        ret = call(*rargs)
+        if checked:
+            raise_error()
+        return ret
     _call_closure.__name__ = fn.__name__
-    return _call_closure
\ No newline at end of file
+    if isinstance(retty, TTuple):
+        restype = fn._argtypes_[0]._type_
+        return tuple_dispatcher(_call_closure, restype, retty, allocates)
+    if not (allocates or is_array(retty)):
+        return _call_closure
+
+    def _alloc_closure(*args):
+        with arena() as buffers:
+            ret = _call_closure(*args)
+            if is_array(retty):
+                ret = unwrap_ndarray(ret, retty, buffers, args)
+        return ret
+    _alloc_closure.__name__ = fn.__name__
+    return _alloc_closure
+
+def tuple_dispatcher(fn, restype, retty, allocates):
+    # The compiled function writes the tuple into a struct we pass as 
+    # its first argument.
+    def _tuple_closure(*args):
+        out = restype()
+        if allocates:
+            with arena() as buffers:
+                fn(ctypes.byref(out), *args)
+                return unwrap_tuple(out, retty, buffers, args)
+        fn(ctypes.byref(out), *args)
+        return unwrap_tuple(out, retty, {}, args)
+    _tuple_closure.__name__ = fn.__name__
+    return _tuple_closure
\ No newline at end of file
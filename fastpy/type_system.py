@@ -16,6 +16,9 @@ class TVar(object):
         else:
             return False
 
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
     def __str__(self):
         return self.s
 
@@ -40,6 +43,9 @@ class TCon(object):
     def __hash__(self):
         return hash(self.s)
 
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
     def __str__(self):
         return self.s
 
@@ -65,6 +71,9 @@ class TApp(object):
     def __hash__(self):
         return hash((self.a, self.b))
 
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
     def __str__(self):
         return str(self.a) + " " + str(self.b)
 
@@ -86,9 +95,147 @@ class TFun(object):
         else:
             return False
 
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
     def __str__(self):
         return str(self.argtys) + " -> " + str(self.retty)
 
+class TTuple(object):
+    """Tuple type
+    
+    Attributes:
+        types (TYPE): Description
+    """
+    def __init__(self, types):
+        assert isinstance(types, list)
+        self.types = types
+
+    def __eq__(self, other):
+        if isinstance(other, TTuple):
+            return (self.types == other.types)
+        else:
+            return False
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash(tuple(self.types))
+
+    def __str__(self):
+        return "(" + ", ".join(map(str, self.types)) + ")"
+
+class TRecord(object):
+    """Record type, the element of a NumPy structured array
+    
+    Attributes:
+        fields (TYPE): (name, type, byte offset) of every field
+        itemsize (TYPE): Size of the record in bytes, padding included
+    """
+    def __init__(self, fields, itemsize):
+        assert isinstance(fields, list)
+        self.fields = fields
+        self.itemsize = itemsize
+
+    def field(self, name):
+        for (fname, ty, offset) in self.fields:
+            if fname == name:
+                return ty
+        return None
+
+    def __eq__(self, other):
+        if isinstance(other, TRecord):
+            return (self.fields == other.fields) & (self.itemsize == other.itemsize)
+        else:
+            return False
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash((tuple(self.fields), self.itemsize))
+
+    def __str__(self):
+        return "{" + ", ".join("%s: %s" % (name, ty) for (name, ty, _) in self.fields) + "}"
+
+class TField(object):
+    """Type of a field of a record which is not known yet
+    
+    Attributes:
+        name (TYPE): Description
+        record (TYPE): Description
+    """
+    def __init__(self, record, name):
+        self.record = record
+        self.name = name
+
+    def __eq__(self, other):
+        if isinstance(other, TField):
+            return (self.record == other.record) & (self.name == other.name)
+        else:
+            return False
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash((self.record, self.name))
+
+    def __str__(self):
+        return str(self.record) + "." + self.name
+
+class TElement(object):
+    """Type of the elements of an array, or the type itself for scalars
+    which are broadcast over arrays. Not known before the type is.
+    
+    Attributes:
+        type (TYPE): Description
+    """
+    def __init__(self, type):
+        self.type = type
+
+    def __eq__(self, other):
+        if isinstance(other, TElement):
+            return self.type == other.type
+        else:
+            return False
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash(("Element", self.type))
+
+    def __str__(self):
+        return "Element(" + str(self.type) + ")"
+
+class TArithmetic(object):
+    """Type of the result of arithmetic on operands promoted to a type, 
+    which is the type itself but for booleans: like Python, True + True 
+    is 2, so they are counted as Int64. Not known before the type is.
+    
+    Attributes:
+        type (TYPE): Type the operands are promoted to
+    """
+    def __init__(self, type):
+        self.type = type
+
+    def __eq__(self, other):
+        if isinstance(other, TArithmetic):
+            return self.type == other.type
+        else:
+            return False
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash(("Arithmetic", self.type))
+
+    def __str__(self):
+        return "Arithmetic(" + str(self.type) + ")"
+
 def ftv(x):
     """
     What was this?
@@ -99,19 +246,143 @@ def ftv(x):
         return ftv(x.a) | ftv(x.b)
     elif isinstance(x, TFun):
         return reduce(set.union, map(ftv, x.argtys)) | ftv(x.retty)
+    elif isinstance(x, TTuple):
+        return reduce(set.union, map(ftv, x.types), set())
+    elif isinstance(x, TRecord):
+        return set()
+    elif isinstance(x, TField):
+        return ftv(x.record)
+    elif isinstance(x, (TElement, TArithmetic)):
+        return ftv(x.type)
     elif isinstance(x, TVar):
         return set([x])
 
 def is_array(ty):
     return isinstance(ty, TApp) and ty.a == TCon("Array")
 
+def is_object(ty):
+    return isinstance(ty, TApp) and ty.a == TCon("Object")
+
+boolean = TCon("Bool")
+int8 = TCon("Int8")
+uint8 = TCon("UInt8")
+int16 = TCon("Int16")
+uint16 = TCon("UInt16")
 int32 = TCon("Int32")
 int64 = TCon("Int64")
 float32 = TCon("Float")
 double64 = TCon("Double")
 void = TCon("Void")
 array = lambda t: TApp(TCon("Array"), t)
+# Object of a jitclass, passed by pointer to the record of its fields.
+object_type = lambda record: TApp(TCon("Object"), record)
 
+array_bool = array(boolean)
+array_int8 = array(int8)
+array_uint8 = array(uint8)
+array_int16 = array(int16)
+array_uint16 = array(uint16)
 array_int32 = array(int32)
 array_int64 = array(int64)
-array_double64 = array(double64)
\ No newline at end of file
+array_float32 = array(float32)
+array_double64 = array(double64)
+
+# NumPy names of the types an array can hold.
+numpy_names = {
+    boolean  : 'bool',
+    int8     : 'int8',
+    uint8    : 'uint8',
+    int16    : 'int16',
+    uint16   : 'uint16',
+    int32    : 'int32',
+    int64    : 'int64',
+    float32  : 'float32',
+    double64 : 'float64',
+}
+
+dtype_names = dict((name, ty) for (ty, name) in numpy_names.items())
+dtype_names.update({'bool_': boolean, 'int': int64, 'float': double64, 'double': double64})
+
+# Numeric promotion lattice, ordered from the narrowest to the widest type.
+# Mixing two numeric types promotes both operands to the narrowest type
+# which can represent both of them, like C and NumPy do.
+numeric_types = [boolean, uint8, int8, uint16, int16, int32, int64, float32, double64]
+signed_types = [int8, int16, int32, int64]
+unsigned_types = [boolean, uint8, uint16]
+integer_types = unsigned_types + signed_types
+float_types = [float32, double64]
+
+integer_bits = {
+    boolean : 1,
+    int8    : 8,
+    uint8   : 8,
+    int16   : 16,
+    uint16  : 16,
+    int32   : 32,
+    int64   : 64,
+}
+
+def is_integer(ty):
+    return ty in integer_types
+
+def is_unsigned(ty):
+    return ty in unsigned_types
+
+def is_float(ty):
+    return ty in float_types
+
+def promote(ty1, ty2):
+    """Least upper bound of two types in the promotion lattice.
+
+    Tuples are promoted element by element and the rest of 
+    non numeric types (arrays) only join with themselves.
+
+    Returns:
+        TYPE: The promoted type, or None if the types can't be joined.
+    """
+    if ty1 == ty2:
+        return ty1
+    elif isinstance(ty1, TTuple) and isinstance(ty2, TTuple):
+        if len(ty1.types) != len(ty2.types):
+            return None
+        types = map(promote, ty1.types, ty2.types)
+        return None if None in types else TTuple(types)
+    elif ty1 not in numeric_types or ty2 not in numeric_types:
+        return None
+    elif is_float(ty1) or is_float(ty2):
+        return max(ty1, ty2, key=numeric_types.index)
+    elif is_unsigned(ty1) == is_unsigned(ty2) or boolean in (ty1, ty2):
+        return max(ty1, ty2, key=integer_bits.get)
+    else:
+        # Mixed signedness needs a signed type wider than the unsigned one.
+        (signed, unsigned) = (ty2, ty1) if is_unsigned(ty1) else (ty1, ty2)
+        bits = max(integer_bits[signed], 2 * integer_bits[unsigned])
+        return [ty for ty in signed_types if integer_bits[ty] >= bits][0]
+
+def dump_type(ty):
+    """JSON friendly representation of a concrete argument type."""
+    if is_array(ty):
+        return ["Array", dump_type(ty.b)]
+    elif is_object(ty):
+        return ["Object", dump_type(ty.b)]
+    elif isinstance(ty, TTuple):
+        return ["Tuple"] + map(dump_type, ty.types)
+    elif isinstance(ty, TRecord):
+        fields = [[name, dump_type(fty), offset] for (name, fty, offset) in ty.fields]
+        return ["Record", fields, ty.itemsize]
+    else:
+        return ty.s
+
+def load_type(obj):
+    """Inverse of dump_type."""
+    if isinstance(obj, list) and obj[0] == "Array":
+        return array(load_type(obj[1]))
+    elif isinstance(obj, list) and obj[0] == "Object":
+        return object_type(load_type(obj[1]))
+    elif isinstance(obj, list) and obj[0] == "Tuple":
+        return TTuple(map(load_type, obj[1:]))
+    elif isinstance(obj, list) and obj[0] == "Record":
+        fields = [(str(name), load_type(fty), offset) for (name, fty, offset) in obj[1]]
+        return TRecord(fields, obj[2])
+    else:
+        return TCon(str(obj))
@@ -8,10 +8,25 @@ test_fastpy
 Tests for `fastpy` module.
 """
 
+import array
+import ctypes
+import pickle
+import sys
+
 import pytest
+import numpy as np
+
+from fastpy.fastpy import fast, pipeline
+
 
+@fast
+def scale(a, x):
+  for i in range(a.shape[0]):
+    a[i] = a[i] * x
+  return x
 
-from fastpy.fastpy import fast
+
+SCALE = 3
 
 
 class TestFastpy(object):
@@ -42,6 +57,615 @@ class TestFastpy(object):
         assert add(2,3) == 5
         assert add(2.0, 3.0) == 5.0
 
+    def test_same_name(self):
+
+        @fast
+        def add(x,y):
+          return x + y
+
+        first = add
+
+        @fast
+        def add(x,y):
+          return x * y
+
+        assert first(2, 3) == 5
+        assert add(2, 3) == 6
+
+    def test_promotion(self):
+
+        @fast
+        def add(x,y):
+          return x + y
+
+        assert add(2, 0.5) == 2.5
+        assert add(0.5, 2) == 2.5
+
+    def test_int64(self):
+
+        @fast
+        def mult(x,y):
+          return x * y
+
+        assert mult(2**31, 4) == 2**33
+
+    def test_mixed_arrays(self):
+
+        @fast
+        def dot(a, b, n):
+          acc = 0
+          for i in range(n):
+            acc += a[i] * b[i]
+          return acc
+
+        a = np.arange(4, dtype=np.int32)
+        b = np.ones(4) * 0.5
+        assert dot(a, b, 4) == 3.0
+
+    def test_scalar_types(self):
+
+        @fast
+        def add(x,y):
+          return x + y
+
+        assert add(np.float32(0.5), np.float32(0.25)) == 0.75
+        assert add(np.int32(2), np.int16(3)) == 5
+        assert add(np.float64(0.5), 1) == 1.5
+        assert add(True, True) == 2
+        assert add(np.bool_(True), np.bool_(True)) == 2
+        assert add(np.longlong(2), np.intc(3)) == 5
+        assert add(long(2), 2**40) == 2**40 + 2
+        with pytest.raises(Exception):
+          add(2**64, 1)
+
+    def test_narrow_dtypes(self):
+
+        @fast
+        def total(a, n):
+          acc = 0
+          for i in range(n):
+            acc += a[i]
+          return acc
+
+        assert total(np.array([200, 100], dtype=np.uint8), 2) == 300
+        assert total(np.array([-1, 3], dtype=np.int16), 2) == 2
+        assert total(np.array([True, False, True]), 3) == 2
+        assert total(np.array([0.5, 0.25], dtype=np.float32), 2) == 0.75
+
+        @fast
+        def first(a):
+          return a[0]
+
+        @fast
+        def first_two(a, b):
+          return a[0], b[0]
+
+        assert first(np.array([200], dtype=np.uint8)) == 200
+        assert first(np.array([60000], dtype=np.uint16)) == 60000
+        assert first(np.array([True])) is True
+        assert first_two(np.array([200], dtype=np.uint8), np.array([False])) == (200, False)
+
+        @fast
+        def count(m, n):
+          c = 0
+          for i in range(m, n):
+            c += 1
+          return c
+
+        assert count(np.uint8(100), np.uint8(200)) == 100
+
+    def test_record_arrays(self):
+
+        @fast
+        def shift(a, n, dx):
+          acc = 0
+          for i in range(n):
+            a[i].x += dx
+            a['y'][i] = a[i].x * 2
+            acc += a[i].ts
+          return acc
+
+        dtype = np.dtype([('ts', 'i8'), ('x', 'f4'), ('y', 'f4')])
+        a = np.zeros(3, dtype=dtype)
+        a['ts'] = [1, 2, 3]
+        a['x'] = [0.5, 1.5, 2.5]
+        assert shift(a, 3, 1.0) == 6
+        assert a['x'].tolist() == [1.5, 2.5, 3.5]
+        assert a['y'].tolist() == [3.0, 5.0, 7.0]
+
+        # Padding inserted by aligned dtypes is skipped.
+        aligned = np.dtype([('ts', 'i8'), ('x', 'f4'), ('y', 'f4'), ('flag', '?')], align=True)
+        b = np.zeros(2, dtype=aligned)
+        b['ts'] = [4, 5]
+        assert shift(b, 2, 1.0) == 9
+        assert b['y'].tolist() == [2.0, 2.0]
+
+    def test_array_expressions(self):
+
+        @fast
+        def axpy(c, a, b, d):
+          c[:] = a * b + d
+          c[:] += 1
+          return (a * b).sum()
+
+        a = np.arange(4.0)
+        b = np.arange(4, dtype=np.int32)
+        c = np.empty(4, dtype=np.float32)
+        assert axpy(c, a, b, 0.5) == 14.0
+        assert c.tolist() == [1.5, 2.5, 5.5, 10.5]
+        body = str(list(axpy.llfuncs.values())[0])
+        assert 'fastpy_allocate' not in body
+
+        # Like NumPy, operands of different sizes are rejected.
+        with pytest.raises(ValueError):
+          axpy(c, np.arange(5.0), b, 0.5)
+        with pytest.raises(ValueError):
+          axpy(np.empty(3, dtype=np.float32), a, b, 0.5)
+
+    def test_reductions(self):
+
+        @fast
+        def stats(a, b):
+          return sum(a), a.max(), np.argmin(a), np.dot(a, b), np.mean(a), min(a.min(), 0)
+
+        a = np.array([3.0, -1.5, 4.0, -1.5, 5.0, 9.0, 2.0])
+        b = np.arange(7, dtype=np.int64)
+        assert stats(a, b) == (20.0, 9.0, 1, np.dot(a, b), 20.0 / 7, -1.5)
+        with pytest.raises(ValueError):
+          stats(a, np.arange(6, dtype=np.int64))
+
+        @fast
+        def weighted(a, w):
+          return (a * w).sum()
+
+        assert weighted(a, a) == (a * a).sum()
+        with pytest.raises(ValueError):
+          weighted(a, a[:3].copy())
+
+        @fast
+        def argmax(a):
+          return np.argmax(a)
+
+        assert argmax(np.array([1, 7, 3, 7, 7], dtype=np.int16)) == 1
+        assert argmax(np.array([200, 100], dtype=np.uint8)) == 0
+
+        @fast
+        def extremes(a):
+          return a.min(), a.max(), np.argmin(a), np.argmax(a)
+
+        nan = float('nan')
+        a = np.array([3.0, -1.5, 4.0, nan, 5.0, nan, 9.0, 2.0])
+        lo, hi, first, last = extremes(a)
+        assert np.isnan(lo) and np.isnan(hi)
+        assert (first, last) == (np.argmin(a), np.argmax(a)) == (3, 3)
+        with pytest.raises(ValueError):
+          extremes(np.empty(0))
+
+    def test_allocation(self):
+
+        @fast
+        def squares(n):
+          out = np.empty(n, dtype=np.int64)
+          for i in range(n):
+            out[i] = i * i
+          return out
+
+        assert squares(4).tolist() == [0, 1, 4, 9]
+        assert isinstance(squares(4).base, np.ndarray)
+
+        @fast
+        def double(a):
+          out = np.zeros_like(a)
+          for i in range(a.shape[0]):
+            out[i] += a[i] * 2
+          return out
+
+        a = np.arange(6, dtype=np.float32)
+        assert double(a).dtype == np.float32
+        assert (double(a) == a * 2).all()
+
+    def test_tuple_return(self):
+
+        @fast
+        def sum_count(a, n):
+          total = 0
+          count = 0
+          for i in range(n):
+            total += a[i]
+            count += 1
+          return total, count
+
+        assert sum_count(np.array([1.5, 2.5, 3.0]), 3) == (7.0, 3)
+
+        @fast
+        def squares_count(n):
+          out = np.empty(n)
+          for i in range(n):
+            out[i] = i * i
+          return out, n
+
+        out, n = squares_count(3)
+        assert out.tolist() == [0.0, 1.0, 4.0] and n == 3
+
+    def test_background_compilation(self):
+
+        @fast(background=True)
+        def add(x,y):
+          return x + y
+
+        assert add(2, 3) == 5
+        add.compile_async(2, 3).result()
+        assert add(2, 3) == 5
+
+        # Unpickled functions run their source while compiling.
+        clone = pickle.loads(pickle.dumps(add))
+        assert clone.fallback(2.0, 0.5) == 2.5
+        assert clone(2.0, 0.5) == 2.5
+
+        @fast
+        def mult(x,y):
+          return x * y
+
+        mult.compile_async(2.0, 3.0).result()
+        assert mult(2.0, 3.0) == 6.0
+
+    def test_tiered_compilation(self):
+        import fastpy.fastpy as fastpy
+
+        @fast(tiered=True)
+        def add(x,y):
+          return x + y
+
+        key, _ = add.key([fastpy.int64, fastpy.int64])
+        assert add(2, 3) == 5
+        quick = add.llfuncs[key]
+        assert add.codegen_report()[(fastpy.int64, fastpy.int64)]['opt'] == fastpy.quick_opt
+        for _ in range(fastpy.hot_threshold):
+          assert add(2, 3) == 5
+        fastpy.background_executor().submit(lambda: None).result()
+        assert add.llfuncs[key] is not quick
+        assert add.codegen_report()[(fastpy.int64, fastpy.int64)]['opt'] == 3
+        assert add(2, 3) == 5
+
+    def test_profile_guided(self):
+        import fastpy.fastpy as fastpy
+
+        @fast(profile=True)
+        def total(a, n):
+          acc = 0
+          for i in range(n):
+            acc += a[i]
+          return acc
+
+        a = np.arange(4.0)
+        signature = (fastpy.array(fastpy.double64), fastpy.int64)
+        assert total(a, 4) == 6.0
+        key = list(total.specializations)[0]
+        profiled = total.llfuncs[key]
+        for _ in range(fastpy.hot_threshold - 1):
+          assert total(a, 4) == 6.0
+        fastpy.background_executor().submit(lambda: None).result()
+        assert total.trip_counts() == {signature: [4.0]}
+        assert total.tuning(key) == dict(opt=2, loop_vectorize=False)
+        # The specialization was rebuilt with the tuned pipeline.
+        assert total.llfuncs[key] is not profiled
+        assert total.codegen_report()[signature]['opt'] == 2
+        assert total(a, 3) == 3.0
+
+    def test_stream(self):
+
+        @fast
+        def running_sum(chunk, carry):
+          for i in range(chunk.shape[0]):
+            carry += chunk[i]
+            chunk[i] = carry
+          return carry
+
+        @fast
+        def moments(chunk, total, count):
+          return total + chunk.sum(), count + chunk.shape[0]
+
+        a = np.arange(10.0)
+        chunks = (a[k:k + 3] for k in range(0, 10, 3))
+        assert running_sum.stream(chunks, state=0.0) == 45.0
+        assert a.tolist() == np.cumsum(np.arange(10.0)).tolist()
+
+        blocks = [np.ones(4), np.ones(2) * 3]
+        assert moments.stream(blocks, state=(0.0, 0), prefetch=True) == (10.0, 6)
+        assert moments.stream(iter([]), state=(0.0, 0), prefetch=True) == (0.0, 0)
+
+    def test_pipeline(self):
+
+        @fast
+        def normalize(x, offset, scale):
+          return (x + offset) * scale
+
+        @fast
+        def threshold(x, t):
+          return max(x, t)
+
+        @fast
+        def accumulate(acc, x):
+          return acc + x
+
+        a = np.arange(5.0)
+        out = np.empty(5)
+        clipped = pipeline(normalize, threshold)
+        assert clipped(a, out, -1.0, 2.0, 0.0) is out
+        assert out.tolist() == [0.0, 0.0, 2.0, 4.0, 6.0]
+        with pytest.raises(ValueError):
+          clipped(a, np.empty(3), -1.0, 2.0, 0.0)
+
+        total = pipeline(normalize, threshold, accumulate, fold=True)
+        assert total(a, 0.0, -1.0, 2.0, 0.0) == 12.0
+        assert pickle.loads(pickle.dumps(total))(a, 1.0, -1.0, 2.0, 0.0) == 13.0
+
+        # Stages read their globals, not the arguments of the pipeline.
+        acc = 10.0
+
+        @fast
+        def shift(x):
+          return x + acc
+
+        assert pipeline(shift)(a, out).tolist() == [10.0, 11.0, 12.0, 13.0, 14.0]
+        assert pipeline(shift, accumulate, fold=True)(a, 0.0) == 60.0
+
+    def test_codegen_report(self):
+
+        @fast
+        def saxpy(out, a, b):
+          for i in range(out.shape[0]):
+            out[i] = a[i] * 2.0 + b[i]
+          return out
+
+        a = np.arange(64.0)
+        saxpy(np.empty(64), a, a)
+        report, = saxpy.codegen_report().values()
+        assert report['opt'] == 3
+        assert report['before']['instructions'] > 0
+        assert report['calls'] == []
+        # Catches changes to the emitter or the pipeline which stop vectorization.
+        assert any(loop['vectorized'] and loop['width'] > 1 for loop in report['loops'])
+
+    def test_core_ir(self):
+        source = "def inc(a):\n  return a.sum() + 1\n"
+        f, g = fast(source), fast(source)
+        assert f.ast == g.ast and hash(f.ast) == hash(g.ast)
+        with pytest.raises(AttributeError):
+            f.ast.body = ()
+        assert f(np.arange(3)) == 4
+
+        from fastpy.core_language import LitFloat
+        assert LitFloat(0.0) != LitFloat(-0.0)
+        assert LitFloat(float('nan')) == LitFloat(float('nan'))
+
+    def test_jitclass(self):
+
+        @fast.jitclass
+        class Accumulator(object):
+          __slots__ = {'total': 'float64', 'count': 'int64'}
+
+          def __init__(self, total):
+            self.total = total
+
+          def add(self, a):
+            for i in range(a.shape[0]):
+              self.total += a[i]
+              self.count += 1
+            return self.total
+
+        @fast
+        def scaled(acc, k):
+          return acc.total * k
+
+        acc = Accumulator(1.0)
+        assert acc.add(np.arange(4.0)) == 7.0
+        assert (acc.total, acc.count) == (7.0, 4)
+        assert scaled(acc, 2) == 14.0
+
+        class Counter(Accumulator):
+          __slots__ = ()
+
+        assert scaled(Counter(3.0), 2) == 6.0
+        with pytest.raises(TypeError):
+            fast.jitclass(type('Untyped', (object,), {'__slots__': ['x']}))
+
+    def test_runtime_stats(self):
+        import fastpy.fastpy as fastpy
+
+        @fast(stats=True)
+        def total(a, n):
+          acc = 0
+          for i in range(n):
+            acc += a[i]
+          return acc
+
+        a = np.arange(4.0)
+        for _ in range(3):
+          assert total(a, 4) == 6.0
+        signature = (fastpy.array(fastpy.double64), fastpy.int64)
+        stats = total.runtime_stats()[signature]
+        assert stats['calls'] == 3 and stats['nbytes'] == 3 * a.nbytes
+        assert 0 < stats['max_native_time'] <= stats['native_time'] <= stats['time']
+        total.reset_runtime_stats()
+        assert total.runtime_stats()[signature]['calls'] == 0
+
+    @pytest.mark.skipif(not sys.platform.startswith('linux'), reason="perf is Linux only")
+    def test_perf_map(self):
+        import fastpy.fastpy as fastpy
+        from fastpy import perf
+
+        @fast
+        def mult(x, y):
+          return x * y
+
+        fastpy.enable_perf_map()
+        try:
+          assert mult(2, 3) == 6
+        finally:
+          fastpy.enable_perf_map(False)
+        with open(perf.map_path()) as f:
+          entries = [line.split(' ', 2) for line in f]
+        start, size, name = entries[-1]
+        assert int(size, 16) > 0
+        assert name.startswith('mult(Int64, Int64) [')
+
+    def test_buffers(self, tmpdir):
+
+        @fast
+        def total(a, n):
+          acc = 0
+          for i in range(n):
+            acc += a[i]
+          return acc
+
+        @fast
+        def fill(a, n):
+          for i in range(n):
+            a[i] = 7
+          return n
+
+        path = str(tmpdir.join('data.bin'))
+        np.arange(4, dtype=np.int32).tofile(path)
+        assert total(np.memmap(path, dtype=np.int32, mode='r'), 4) == 6
+        assert total(array.array('d', [1.0, 2.0]), 2) == 3.0
+        assert total(bytearray(b'\x01\x02'), 2) == 3
+        assert total(memoryview(np.arange(3.0)), 3) == 3.0
+        # The item format of the buffer gives the element type.
+        assert total((ctypes.c_int32 * 3)(1, 2, 300), 3) == 303
+        with pytest.raises(ValueError):
+          total(np.arange(8.0)[::2], 4)
+        with pytest.raises(Exception):
+          total('ab', 2)
+
+        buf = bytearray(2)
+        fill(buf, 2)
+        assert buf == bytearray(b'\x07\x07')
+        with pytest.raises(ValueError):
+          fill(np.memmap(path, dtype=np.int32, mode='r'), 4)
+
+    def test_pickle(self):
+
+        @fast
+        def add(x,y):
+          return x + y
+
+        assert add(2, 3) == 5
+        clone = pickle.loads(pickle.dumps(add))
+        assert clone.signatures == add.signatures
+        assert clone(2, 3) == 5
+        assert clone(2.0, 3) == 5.0
+
+    def test_captured_variables(self):
+        global SCALE
+        weights = np.array([1.0, 2.0, 4.0])
+
+        @fast
+        def weighted(a):
+          acc = 0
+          for i in range(weights.shape[0]):
+            acc += a[i] * weights[i] * SCALE
+          return acc
+
+        a = np.ones(3)
+        assert weighted(a) == 21.0
+        # The captured values are only typed again once rebound.
+        consts = weighted.last_captured[1]
+        assert weighted(a) == 21.0
+        assert weighted.last_captured[1] is consts
+        try:
+          SCALE = 0.5
+          assert weighted(a) == 3.5
+          assert len(weighted.specializations) == 2
+        finally:
+          SCALE = 3
+        clone = pickle.loads(pickle.dumps(weighted))
+        assert clone(a) == 21.0
+
+    def test_specialize_on(self):
+        import fastpy.fastpy as fastpy
+
+        globals_before = fastpy.jit_footprint()['globals']
+
+        @fast(specialize_on=['k', 'a'])
+        def window(a, k):
+          acc = 0
+          for i in range(k):
+            acc += a[i]
+          return acc + a.shape[0]
+
+        a = np.arange(10.0)
+        assert window(a, 3) == 13.0
+        assert window(a, 5) == 20.0
+        assert window(a[:4], 3) == 7.0
+        assert len(window.specializations) == 3
+        assert window(a, 3) == 13.0
+        assert len(window.specializations) == 3
+        # The shapes specialized on are freed with the machine code.
+        assert fastpy.jit_footprint()['globals'] > globals_before
+        for key in list(window.specializations):
+          window.evict(key)
+        assert fastpy.jit_footprint()['globals'] == globals_before
+        with pytest.raises(ValueError):
+          fast(specialize_on=['n'])(window.source)
+
+    def test_locals_promoted_to_registers(self):
+
+        @fast
+        def triangle(n):
+          x = 0
+          for i in range(n):
+            y = i * 2
+            x += y
+          return x
+
+        assert triangle(4) == 12
+        ir = str(list(triangle.llfuncs.values())[0])
+        assert 'alloca' not in ir
+        assert ' load ' not in ir and ' store ' not in ir
+
+    def test_lru_eviction(self):
+        import fastpy.fastpy as fastpy
+
+        @fast(max_specializations=2)
+        def add(x,y):
+          return x + y
+
+        assert add(1, 2) == 3
+        assert add(1.0, 2.0) == 3.0
+        assert add(1, 2) == 3
+        functions = fastpy.jit_footprint()['functions']
+        assert add(1, 2.0) == 3.0
+        assert len(add.specializations) == 2
+        assert len(add.llfuncs) == 2
+        assert fastpy.jit_footprint()['functions'] == functions
+        # The least recently used specialization was (Double, Double).
+        assert add(1, 2) == 3
+        assert add(1.0, 2.0) == 3.0
+
+        # Calls holding on to evicted code are dispatched again.
+        key, _ = add.key([fastpy.int64, fastpy.int64])
+        stale, code = fastpy.function_cache[key], fastpy.machine_code[key]
+        add.evict(key)
+        assert code.retired and code not in fastpy._retired
+        assert stale(1, 2) == 3
+
+    def test_manifest(self, tmpdir):
+        import fastpy
+        from fastpy.type_system import array, double64
+
+        path = str(tmpdir.join('manifest.jsonl'))
+        fastpy.record(path)
+        try:
+          scale(np.ones(3), 2.0)
+        finally:
+          fastpy.record(None)
+
+        for key in list(scale.specializations):
+          scale.evict(key)
+        assert fastpy.warmup(path) == 1
+        assert scale.signatures == [[array(double64), double64]]
+
     @classmethod
     def teardown_class(cls):
         pass